@@ -0,0 +1,230 @@
+#!/usr/bin/python3
+
+import argparse
+import concurrent.futures
+import index
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+import url_index
+
+SYLLABLES = [
+    "au", "to", "si", "lni", "ci", "po", "se", "vy", "ra", "lo", "na", "ka", "te",
+    "mes", "ho", "di", "ne", "tez", "ce", "da", "ta", "log", "er", "ror", "re",
+    "quest", "con", "fig", "ser", "ver", "sto", "rage", "ma", "ge", "us", "er",
+]
+LEVELS = ["DEBUG", "INFO", "INFO", "INFO", "WARN", "ERROR"]
+TLDS = ["com", "org", "net", "cz", "io"]
+
+QUERY_KINDS = ("exact", "fuzzy_word", "fuzzy_prefix")
+LENGTH_BUCKETS = ((1, 3, "short"), (4, 7, "medium"), (8, 1000, "long"))
+
+
+class Lexicon:
+    # pseudo-words drawn with a Zipf-like frequency distribution
+    def __init__(self, rng, size):
+        words = set()
+        while len(words) < size:
+            words.add("".join(rng.choice(SYLLABLES) for _ in range(rng.randint(1, 4))))
+        self.words = sorted(words)
+        rng.shuffle(self.words)
+        weights = [1.0 / (rank + 1) for rank in range(size)]
+        self.cum_weights = []
+        total = 0.0
+        for w in weights:
+            total += w
+            self.cum_weights.append(total)
+
+    def sample(self, rng, k=1):
+        return rng.choices(self.words, cum_weights=self.cum_weights, k=k)
+
+
+def log_lines(rng, lexicon, n):
+    for i in range(n):
+        words = " ".join(lexicon.sample(rng, rng.randint(3, 12)))
+        yield "2024-%02d-%02dT%02d:%02d:%02d %s [%s-%d] %s took %dms" % (
+            rng.randint(1, 12), rng.randint(1, 28), rng.randint(0, 23), rng.randint(0, 59), rng.randint(0, 59),
+            rng.choice(LEVELS), lexicon.sample(rng)[0], rng.randint(0, 16), words, rng.randint(1, 5000),
+        )
+
+def urls(rng, lexicon, n):
+    for i in range(n):
+        host = "%s-%s%02d.%s.%s" % (*lexicon.sample(rng, 2), rng.randint(0, 40), lexicon.sample(rng)[0], rng.choice(TLDS))
+        path = "/".join(lexicon.sample(rng, rng.randint(1, 5)))
+        yield "https://%s/%s?%s=%d" % (host, path, lexicon.sample(rng)[0], rng.randint(0, 99999))
+
+CORPORA = {
+    "logs": (log_lines, index.Index),
+    "urls": (urls, url_index.UrlIndex),
+}
+
+
+def _edit(rng, word):
+    # one random edit that keeps the initial, as fuzzy search requires
+    if len(word) < 2:
+        return word
+    i = rng.randrange(1, len(word))
+    op = rng.choice("sid")
+    c = rng.choice("abcdefghijklmnopqrstuvwxyz")
+    if op == "s":
+        return word[:i] + c + word[i + 1:]
+    if op == "i":
+        return word[:i] + c + word[i:]
+    return word[:i] + word[i + 1:]
+
+def make_queries(rng, lexicon, n_queries):
+    queries = []
+    for _ in range(n_queries):
+        n_words = rng.choice((1, 1, 2, 3))
+        words = lexicon.sample(rng, n_words)
+        queries.append(("exact", " ".join(words)))
+        queries.append(("fuzzy_word", " ".join(_edit(rng, w) for w in words) + " "))
+        last = words[-1][:rng.randint(1, len(words[-1]))]
+        queries.append(("fuzzy_prefix", " ".join(words[:-1] + [last])))
+    return queries
+
+def _bucket(query):
+    length = len(query.strip())
+    for lo, hi, name in LENGTH_BUCKETS:
+        if lo <= length <= hi:
+            return name
+    return LENGTH_BUCKETS[-1][2]
+
+def _percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    i = min(len(sorted_values) - 1, int(round(p / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[i]
+
+def _max_rss_bytes():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def run_one(corpus, n_records, n_queries, topn, seed, fuzzy_engine, stream, fuzzy_build=None):
+    rng = random.Random(seed)
+    lexicon = Lexicon(rng, 20000)
+    generate, index_cls = CORPORA[corpus]
+    rss_before = _max_rss_bytes()
+
+    start = time.perf_counter()
+    records = generate(rng, lexicon, n_records)
+    if stream:
+        idx = index_cls.from_stream(records, fuzzy_engine=fuzzy_engine, fuzzy_build=fuzzy_build)
+    else:
+        idx = index_cls(list(records), fuzzy_engine=fuzzy_engine, fuzzy_build=fuzzy_build)
+    build_time = time.perf_counter() - start
+    peak_rss = _max_rss_bytes()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.idx")
+        start = time.perf_counter()
+        idx.save(path)
+        save_time = time.perf_counter() - start
+        index_bytes = os.path.getsize(path)
+
+    latencies = {}
+    for kind, query in make_queries(rng, lexicon, n_queries):
+        # measure every query cold, without earlier queries' cached expansions
+        idx._invalidate_caches()
+        start = time.perf_counter()
+        list(idx.search(query, topn=topn, fuzzy=kind != "exact"))
+        elapsed = time.perf_counter() - start
+        latencies.setdefault((kind, _bucket(query)), []).append(elapsed)
+
+    search = {}
+    for (kind, bucket), values in sorted(latencies.items()):
+        values.sort()
+        search.setdefault(kind, {})[bucket] = {
+            "n": len(values),
+            "p50_ms": 1000 * _percentile(values, 50),
+            "p99_ms": 1000 * _percentile(values, 99),
+        }
+
+    return {
+        "corpus": corpus,
+        "records": n_records,
+        "fuzzy_engine": idx.fuzzy_engine,
+        "fuzzy_build": idx.fuzzy_build,
+        "stream": stream,
+        "build_s": build_time,
+        "save_s": save_time,
+        "peak_rss_bytes": peak_rss,
+        "build_rss_bytes": peak_rss - rss_before,
+        "index_bytes": index_bytes,
+        "terms": len(idx.index),
+        "search": search,
+    }
+
+
+def compare(baseline, result):
+    # ratios of result to baseline for the headline numbers; > 1 is slower/larger
+    key = (result["corpus"], result["records"])
+    base = baseline.get(key)
+    if base is None:
+        return
+    lines = ["%s %d records vs baseline:" % key]
+    for field in ("build_s", "peak_rss_bytes", "index_bytes"):
+        if base[field]:
+            lines.append("  %-16s x%.2f" % (field, result[field] / base[field]))
+    for kind, buckets in result["search"].items():
+        for bucket, stats in buckets.items():
+            base_stats = base["search"].get(kind, {}).get(bucket)
+            if base_stats and base_stats["p50_ms"]:
+                lines.append("  %-12s %-7s p50 x%.2f p99 x%.2f" % (
+                    kind, bucket,
+                    stats["p50_ms"] / base_stats["p50_ms"],
+                    stats["p99_ms"] / base_stats["p99_ms"],
+                ))
+    print("\n".join(lines), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark index build and search on synthetic corpora")
+    parser.add_argument("--sizes", default="10000,100000,1000000", help="comma separated corpus sizes")
+    parser.add_argument("--corpus", choices=sorted(CORPORA) + ["all"], default="all")
+    parser.add_argument("--queries", type=int, default=200, help="queries per kind")
+    parser.add_argument("--topn", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--fuzzy-engine", choices=("bktree", "automaton", "symspell"), default=None)
+    parser.add_argument("--fuzzy-build", choices=("eager", "lazy", "background"), default=None,
+                        help="with lazy or background, build_s leaves out the fuzzy structures and save_s includes them")
+    parser.add_argument("--no-stream", action="store_true", help="build from an in-memory list of records")
+    parser.add_argument("--output", help="append JSON lines here instead of printing them")
+    parser.add_argument("--compare", metavar="BASELINE", help="JSON lines of an earlier run to compare against")
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            for line in f:
+                if line.strip():
+                    r = json.loads(line)
+                    baseline[(r["corpus"], r["records"])] = r
+
+    corpora = sorted(CORPORA) if args.corpus == "all" else [args.corpus]
+    sizes = [int(s) for s in args.sizes.split(",")]
+    out = open(args.output, "a") if args.output else sys.stdout
+    # a fresh process per run keeps peak memory figures independent
+    context = multiprocessing.get_context("spawn")
+    for corpus in corpora:
+        for size in sizes:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                result = pool.submit(
+                    run_one, corpus, size, args.queries, args.topn, args.seed,
+                    args.fuzzy_engine, not args.no_stream, args.fuzzy_build,
+                ).result()
+            result["python"] = platform.python_version()
+            result["timestamp"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+            out.write(json.dumps(result, sort_keys=True) + "\n")
+            out.flush()
+            compare(baseline, result)
+    if out is not sys.stdout:
+        out.close()
@@ -0,0 +1,49 @@
+#!/usr/bin/python3
+
+import collections
+import threading
+
+
+class LRUCache:
+    # Evicts least recently used entries once the summed cost of all entries
+    # exceeds max_cost. Safe to share between searching threads.
+
+    def __init__(self, max_cost):
+        self.max_cost = max_cost
+        self.cost = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, cost=1):
+        with self.lock:
+            if key in self.entries:
+                self.cost -= self.entries.pop(key)[1]
+            if cost > self.max_cost:
+                return
+            self.entries[key] = (value, cost)
+            self.cost += cost
+            while self.cost > self.max_cost:
+                _, (_, evicted_cost) = self.entries.popitem(last=False)
+                self.cost -= evicted_cost
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.cost = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
@@ -0,0 +1,36 @@
+#!/usr/bin/python3
+
+from html import escape
+
+# A formatter renders a record given its highlight spans: sorted,
+# non-overlapping (start, end) char offsets into the record.
+
+
+def ansi(record, highlights):
+    yellow_back = "\033[103m"
+    normal_back = "\033[49m"
+
+    result = []
+    last = 0
+    for start, end in highlights:
+        result.append(record[last:start])
+        result.append(yellow_back + record[start:end] + normal_back)
+        last = end
+    result.append(record[last:])
+    return "".join(result)
+
+def html(record, highlights):
+    result = []
+    last = 0
+    for start, end in highlights:
+        result.append(escape(record[last:start]))
+        result.append("<mark>" + escape(record[start:end]) + "</mark>")
+        last = end
+    result.append(escape(record[last:]))
+    return "".join(result)
+
+def plain(record, highlights):
+    return record
+
+def spans(record, highlights):
+    return record, highlights
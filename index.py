@@ -1,38 +1,240 @@
 #!/usr/bin/python3
 
 import collections
+import concurrent.futures
+import formatters
+import heapq
+import itertools
+import math
+import memory
 import re
-from trees.bktree import BKTree, levenshtein, hamming
+import storage
+import threading
+from cache import LRUCache
+from array import array
+from postings import PostingsList
+from profiling import NO_STAGE
+from trees.bktree import FlatBKTree, levenshtein_fast, hamming
+from trees.dawg import DAWG
+from trees.suffixarray import SuffixArray
+from trees.symspell import SymSpell
 from trees.trie import Trie
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 class Candidate:
-    __slots__ = "doc_id", "edit_distance", "last_occurrences", "min_dist", "highlights"
+    # highlights is a span source, see flatten_highlights()
+    __slots__ = "doc_id", "edit_distance", "last_occurrences", "min_dist", "score", "highlights"
 
     def __init__(self, doc_id, edit_distance, word_occurrences, highlights):
         self.doc_id = doc_id
         self.edit_distance = edit_distance
         self.last_occurrences = word_occurrences
         self.min_dist = 0
+        self.score = 0.0
         self.highlights = highlights
 
     def __repr__(self):
         return "Cand({}, {})".format(self.doc_id, self.edit_distance)
 
-class RecordPosition:
-    __slots__ = "char_position", "word_position"
+class SearchCancelled(Exception):
+    pass
+
+class CancelToken:
+    # Passed to search(); cancelling it from any thread makes the search
+    # give up at its next check with SearchCancelled.
+    __slots__ = "cancelled"
+
+    def __init__(self):
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+# cancel token and partial results callback of the search running on this thread
+_control = threading.local()
+
+def _check_cancelled(cancel):
+    if cancel is not None and cancel.cancelled:
+        raise SearchCancelled()
+
+class TermSpans:
+    # the highlight spans of one term match in one document, listed lazily
+    __slots__ = "match", "doc_id"
+
+    def __init__(self, match, doc_id):
+        self.match = match
+        self.doc_id = doc_id
+
+    def __iter__(self):
+        return self.match.spans(self.doc_id)
+
+def flatten_highlights(source):
+    # A span source is a list of (start, end) spans, any other iterable of
+    # them such as TermSpans, or a tuple of span sources. Merging candidates
+    # just pairs their sources up; the spans are only collected here.
+    spans = []
+    stack = [source]
+    while stack:
+        source = stack.pop()
+        if isinstance(source, tuple):
+            stack.extend(source)
+        else:
+            spans.extend(source)
+    return spans
+
+class Hit:
+    # One search result. Its highlight spans are only worked out, and its
+    # record only fetched, when asked for.
+    __slots__ = "index", "doc_id", "edit_distance", "min_dist", "score", "_highlights"
+
+    def __init__(self, index, candidate):
+        self.index = index
+        self.doc_id = candidate.doc_id
+        self.edit_distance = candidate.edit_distance
+        self.min_dist = candidate.min_dist
+        self.score = candidate.score
+        self._highlights = candidate.highlights
+
+    @property
+    def record(self):
+        return self.index.records[self.doc_id]
+
+    def spans(self):
+        # sorted, merged (start, end) char offsets of the matched terms
+        return self.index._merge_highlights(flatten_highlights(self._highlights))
+
+    def render(self, formatter=formatters.ansi):
+        return formatter(self.record, self.spans())
+
+    def __repr__(self):
+        return "Hit({}, {}, {})".format(self.doc_id, self.edit_distance, self.min_dist)
 
-    def __init__(self, char_position, word_position):
-        self.char_position = char_position
-        self.word_position = word_position
+class TermMatch:
+    # Documents matched by one query term: the smallest edit distance per
+    # document, documents grouped by that distance, and the (postings, start,
+    # end) occurrence ranges of every derived word found in each document.
+    # For infix matches, shifts maps each derived word's postings to where
+    # the term starts inside that word. doc_freq counts all documents the
+    # term matches, also when the match is restricted to some of them (see
+    # Index._probe_words), None if that is not known.
+    __slots__ = "length", "distances", "levels", "occurrences", "shifts", "doc_freq"
+
+    def __init__(self, length, shifts=None):
+        self.length = length
+        self.distances = {}
+        self.levels = collections.defaultdict(list)
+        self.occurrences = collections.defaultdict(list)
+        self.shifts = shifts
+        self.doc_freq = None
+
+    def positions(self, doc_id, attr):
+        ranges = self.occurrences[doc_id]
+        if len(ranges) == 1:
+            postings, start, end = ranges[0]
+            return getattr(postings, attr)[start:end]
+        return array("I", sorted(itertools.chain.from_iterable(
+            getattr(postings, attr)[start:end] for postings, start, end in ranges
+        )))
+
+    def spans(self, doc_id):
+        # (start, end) char offsets of the matched text in doc_id, unsorted
+        length, shifts = self.length, self.shifts
+        for postings, start, end in self.occurrences[doc_id]:
+            shift = shifts[postings] if shifts is not None else 0
+            for c in postings.chars[start:end]:
+                yield c + shift, c + shift + length
+
+class PhrasePrefix:
+    # All terms of a query but the last, merged lazily per combination of
+    # their distance levels into {doc_id: min_dist}. Kept across keystrokes
+    # that only extend the last term.
+    __slots__ = "matches", "merged"
+
+    def __init__(self, matches):
+        self.matches = matches
+        self.merged = {}
+
+    def docs(self, levels):
+        docs = self.merged.get(levels)
+        if docs is not None:
+            return docs
+
+        matches = self.matches
+        # drive the intersection from the smallest document list
+        smallest = min(range(len(matches)), key=lambda i: len(matches[i].levels[levels[i]]))
+        doc_ids = [
+            doc_id for doc_id in matches[smallest].levels[levels[smallest]]
+            if all(m.distances.get(doc_id) == d for m, d in zip(matches, levels))
+        ]
+        distances = [0] * len(doc_ids)
+        xpositions = [matches[0].positions(doc_id, "words") for doc_id in doc_ids]
+        for m in matches[1:]:
+            ypositions = [m.positions(doc_id, "words") for doc_id in doc_ids]
+            for i, d in enumerate(min_dists(list(zip(xpositions, ypositions)))):
+                distances[i] += d
+            xpositions = ypositions
+        docs = dict(zip(doc_ids, distances))
+        self.merged[levels] = docs
+        return docs
+
+class BatchTerms:
+    # Term matches shared by the queries of one search_many() batch. Each
+    # distinct term is matched once, by whichever query needs it first, and
+    # dropped as soon as the last query using it is done.
+
+    def __init__(self, index, uses):
+        self.index = index
+        self.uses = uses
+        self.futures = {}
+        self.lock = threading.Lock()
+
+    def match(self, token, is_prefix, fuzzy, derived):
+        key = (token, is_prefix)
+        with self.lock:
+            future = self.futures.get(key)
+            owner = future is None
+            if owner:
+                future = self.futures[key] = concurrent.futures.Future()
+        if owner:
+            try:
+                future.set_result(self.index._match_words(token, *derived))
+            except BaseException as e:
+                future.set_exception(e)
+                raise
+        return future.result()
+
+    def release(self, terms):
+        with self.lock:
+            for key in terms:
+                self.uses[key] -= 1
+                if not self.uses[key]:
+                    self.futures.pop(key, None)
+
+_batch_index = None
+
+def _init_batch_worker(idx):
+    global _batch_index
+    _batch_index = idx
+
+def _search_batch(queries, topn, fuzzy, formatter):
+    results = _batch_index.search_many(queries, topn, fuzzy, formatter=formatter)
+    if formatter is None:
+        results = [[(h.doc_id, h.edit_distance, h.min_dist, h.score) for h in hits] for hits in results]
+    return results
 
 def min_dist(xpositions, ypositions):
+    # xpositions, ypositions are sorted word positions
     d = 1337
     ix = iy = 0
     penalty = 1
     while ix < len(xpositions) and iy < len(ypositions):
-        x = xpositions[ix].word_position
-        y = ypositions[iy].word_position
+        x = xpositions[ix]
+        y = ypositions[iy]
         if x < y:
             diff = y - x - 1
             ix += 1
@@ -47,196 +249,1118 @@ def min_dist(xpositions, ypositions):
 
     return d
 
+# NumPy only pays off for batches of this many pairs with at least this many
+# positions per pair on average; min_dist() often returns after a few steps
+MIN_DISTS_NUMPY_BATCH = 64
+MIN_DISTS_NUMPY_POSITIONS = 16
+# Index._rank() takes documents at most this many at a time, scoring their
+# proximity in one min_dists() call when the heap keeps them all or NumPy
+# pays off, and one by one otherwise, so that the heap can turn documents
+# away unscored
+RANK_BATCH = 256
+# Rough bytes a cached entry holds: per matched document of a TermMatch, per
+# derived word or infix offset, and for the entry itself, as measured with
+# memory.sizeof() without the postings they point into
+CACHE_DOC_BYTES = 320
+CACHE_WORD_BYTES = 100
+CACHE_ENTRY_BYTES = 200
+
+def min_dists(pairs):
+    # min_dist() of every (xpositions, ypositions) pair
+    if _min_dists_pay_off(pairs):
+        return _min_dists_numpy(pairs)
+    return [min_dist(xpositions, ypositions) for xpositions, ypositions in pairs]
+
+def _min_dists_pay_off(pairs):
+    if numpy is None or len(pairs) < MIN_DISTS_NUMPY_BATCH:
+        return False
+    n_positions = sum(len(xpositions) + len(ypositions) for xpositions, ypositions in pairs)
+    return n_positions >= MIN_DISTS_NUMPY_POSITIONS * len(pairs)
+
+def _flatten_positions(positions):
+    # Concatenates the position lists into one sorted array of keys that
+    # carry the list's index in the high 32 bits.
+    lengths = numpy.array(list(map(len, positions)), numpy.int64)
+    flat = numpy.frombuffer(b"".join(map(bytes, positions)), numpy.uint32)
+    owners = numpy.repeat(numpy.arange(len(positions), dtype=numpy.int64), lengths)
+    return (owners << 32) | flat
+
+def _min_dists_numpy(pairs):
+    # The same walk as min_dist(), for all pairs at once: x and y positions
+    # are merged into one order (x first on ties) and every neighbouring
+    # (x, y) of the same pair is a candidate, costing y - x - 1 when x comes
+    # first and x - y otherwise.
+    xkeys = _flatten_positions([x for x, _ in pairs])
+    ykeys = _flatten_positions([y for _, y in pairs])
+    keys = numpy.concatenate((xkeys, ykeys))
+    # both halves are already sorted, so the stable sort is a single merge
+    order = numpy.argsort(keys, kind="stable")
+    keys = keys[order]
+    is_x = order < len(xkeys)
+
+    left, right = keys[:-1], keys[1:]
+    neighbours = (is_x[:-1] != is_x[1:]) & ((left >> 32) == (right >> 32))
+    cost = right - left - is_x[:-1]
+    owners, cost = left[neighbours] >> 32, cost[neighbours]
+    result = numpy.full(len(pairs), 1337, numpy.int64)
+    if len(owners):
+        # owners are sorted, reduce every run of the same pair at once
+        starts = numpy.flatnonzero(numpy.concatenate(([True], owners[1:] != owners[:-1])))
+        owners = owners[starts]
+        result[owners] = numpy.minimum(result[owners], numpy.minimum.reduceat(cost, starts))
+    return numpy.maximum(result, 0).tolist()
 
 
 class Index:
+    # compact in the background once this fraction of records is tombstoned
+    compaction_threshold = 0.2
+    # "bktree" searches prefixes stored in edits_lev/edits_3, "automaton"
+    # walks word_trie directly and does not build the BK-trees at all,
+    # "symspell" keeps the prefixes' deletion variants in edits_lev instead
+    fuzzy_engine = "bktree"
+    # deepest deletion variants the symspell engine stores; terms looked up
+    # with a larger limit go through the automaton. Lower it to save memory.
+    symspell_max_distance = 3
+    # "eager" builds edits_lev/edits_3 along with the postings, "lazy" on the
+    # first fuzzy search, "background" on a thread started once the records
+    # are indexed; exact and prefix search work in the meantime
+    fuzzy_build = "eager"
+    # what a fuzzy search does while they are not built: "wait" for them, or
+    # "degrade" to exact terms and a prefix last term, while a background
+    # thread builds them
+    fuzzy_policy = "wait"
+    # estimated bytes of cached term expansions and matches, see
+    # CACHE_DOC_BYTES; a single match above it is not cached at all
+    cache_cost = 64 * 2**20
+    # a profiling.Profiler recording where searches spend their time
+    profiler = None
+    # "distance" ranks by (edit distance, min_dist, doc id), "bm25" breaks
+    # ties in (edit distance, min_dist) by BM25 score instead of doc id
+    ranking = "distance"
+    bm25_k1 = 1.2
+    bm25_b = 0.75
+    # A fuzzy query term expanding to more derived words than this keeps
+    # only the closest ones and, among equally close ones, those in the most
+    # documents; the others' postings are never read. None keeps them all.
+    max_expansions = None
+    # In a query of several terms, a term whose postings hold more than
+    # probe_ratio times the documents of the rarest term's is not decoded
+    # whole: only the documents matching the other terms are looked up in
+    # it, through its skip entries. math.inf decodes every term.
+    probe_ratio = 8
+    # the attributes above that an instance may override, kept when a
+    # memory-mapped index is pickled by its path
+    _settings = (
+        "compaction_threshold", "symspell_max_distance", "fuzzy_build", "fuzzy_policy", "cache_cost",
+        "ranking", "bm25_k1", "bm25_b", "max_expansions", "probe_ratio",
+    )
 
-    def __init__(self, records):
-        self.records = records
+    def __init__(self, records, fuzzy_engine=None, fuzzy_build=None):
+        if fuzzy_engine is not None:
+            if fuzzy_engine not in ("bktree", "automaton", "symspell"):
+                raise ValueError("unknown fuzzy engine {!r}".format(fuzzy_engine))
+            self.fuzzy_engine = fuzzy_engine
+        self._set_fuzzy_build(fuzzy_build)
+        # a copy: add_records, update and compact write to it
+        self.records = list(records)
+        # number of tokens of each record, for BM25
+        self.doc_lengths = array("I")
         self.index = {}
-        self.edits_lev = BKTree(levenshtein)
-        self.edits_3 = BKTree(hamming)
+        self._edits_pending = self.fuzzy_build != "eager" and self.fuzzy_engine != "automaton"
+        self.edits_lev, self.edits_3 = (None, None) if self._edits_pending else self._new_edit_indexes()
         self.word_trie = Trie()
 
         self.word_set = set()
 
-        self._index(records)
+        self._init_write_state(())
+        self._init_caches()
+        self._index(self.records)
+        if self.records:
+            # from_stream() starts it once all batches are in
+            self._start_background_build()
+
+    @classmethod
+    def from_stream(cls, lines, records_path=None, batch_size=10000, freeze=False, **kwargs):
+        # Indexes an iterable of records batch by batch, keeping the records
+        # in a storage.RecordFile at records_path (or an anonymous temporary
+        # file) instead of in memory; search reads back only the top-n.
+        # freeze=True freezes the result before a background fuzzy build
+        # starts, since freeze() would wait for that build to finish.
+        self = cls([], **kwargs)
+        self.records = storage.RecordFile(records_path)
+        lines = iter(lines)
+        while True:
+            batch = list(itertools.islice(lines, batch_size))
+            if not batch:
+                break
+            self.add_records(batch)
+        if freeze:
+            self.freeze()
+        self._start_background_build()
+        return self
+
+    def __getstate__(self):
+        if isinstance(self.index, storage.MappedIndex):
+            # mapped memory cannot be pickled, the file is opened again
+            state = {"_path": self._path, "deleted": self.deleted, "_tombstones": self._tombstones}
+            state.update((name, self.__dict__[name]) for name in self._settings if name in self.__dict__)
+            return state
+        # locks, threads and caches are per process
+        state = self.__dict__.copy()
+        for attr in ("_write_lock", "_compaction", "_edits_build", "_cache", "_last_prefix", "_suffix_array"):
+            del state[attr]
+        state.pop("profiler", None)
+        return state
+
+    def __setstate__(self, state):
+        if "_path" in state:
+            state = dict(type(self).load(state["_path"], state.get("fuzzy_build")).__dict__, **state)
+        self.__dict__.update(state)
+        self._write_lock = threading.RLock()
+        self._compaction = None
+        self._edits_build = None
+        self._init_caches()
+
+    def save(self, path):
+        with self._write_lock:
+            # saved BK-trees are mapped as they are, never built on load
+            if self.fuzzy_engine == "bktree":
+                self._build_edit_indexes()
+            storage.save_index(self, path)
+
+    @classmethod
+    def load(cls, path, fuzzy_build=None):
+        mm, sections = storage.open_sections(path)
+        terms = storage.MappedTerms(sections["terms"])
+
+        meta = storage.load_meta(sections)
+
+        self = cls.__new__(cls)
+        self._mmap = mm
+        self._path = path
+        self.fuzzy_engine = meta["fuzzy_engine"]
+        self._set_fuzzy_build(fuzzy_build)
+        self.records = storage.MappedStrings(sections["records"])
+        self.doc_lengths = sections["doc_lengths"].cast("I")
+        self.index = storage.MappedIndex(terms, sections["postings"])
+        if "edits_lev" in sections:
+            self.edits_lev = storage.MappedBKTree(sections["edits_lev"], levenshtein_fast, bounded=True)
+            self.edits_3 = storage.MappedBKTree(sections["edits_3"], hamming)
+            self._edits_pending = False
+        else:
+            # symspell variants are not saved but rebuilt from the terms
+            self.edits_lev = self.edits_3 = None
+            self._edits_pending = self.fuzzy_engine == "symspell"
+        self.word_trie = storage.MappedTrie(terms)
+        self.word_set = set()
+        self._init_write_state(meta["deleted"])
+        self._init_caches()
+        if self.fuzzy_build == "eager":
+            self._build_edit_indexes()
+        else:
+            self._start_background_build()
+        return self
+
+    def _set_fuzzy_build(self, fuzzy_build):
+        if fuzzy_build is not None:
+            if fuzzy_build not in ("eager", "lazy", "background"):
+                raise ValueError("unknown fuzzy build {!r}".format(fuzzy_build))
+            self.fuzzy_build = fuzzy_build
+
+    def _new_edit_indexes(self):
+        if self.fuzzy_engine == "symspell":
+            # the 3-char prefixes of edits_3 are among those of edits_lev
+            return SymSpell(self._symspell_depths()), None
+        if self.fuzzy_engine != "bktree":
+            return None, None
+        return FlatBKTree(levenshtein_fast, bounded=True), FlatBKTree(hamming)
+
+    def fuzzy_ready(self):
+        # whether fuzzy search runs at full strength rather than waiting or
+        # degrading, see fuzzy_policy
+        return not self._edits_pending
+
+    def _start_background_build(self):
+        if self._edits_pending and self.fuzzy_build == "background":
+            self._build_edit_indexes(background=True)
+
+    def _build_edit_indexes(self, background=False):
+        # Builds the edits_lev/edits_3 that fuzzy_build deferred, from the
+        # prefixes of all terms. Writers wait for it; searches go on.
+        if background:
+            if self._edits_build is None or not self._edits_build.is_alive():
+                self._edits_build = threading.Thread(target=self._build_edit_indexes, daemon=True)
+                self._edits_build.start()
+            return
+
+        with self._write_lock:
+            if not self._edits_pending:
+                return
+            edits_lev, edits_3 = self._new_edit_indexes()
+            prefixes = sorted({term[:i] for term in self.index for i in range(2, len(term) + 1)})
+            edits_lev.insert_many(prefixes)
+            if edits_3 is not None:
+                edits_3.insert_many(prefix for prefix in prefixes if len(prefix) == 3)
+            self.edits_lev, self.edits_3 = edits_lev, edits_3
+            self._edits_pending = False
+            # drop the expansions of degraded fuzzy searches
+            self._invalidate_caches()
+
+    def _edit_indexes_ready(self):
+        # whether edits_lev/edits_3 can be searched, after waiting for them
+        # if fuzzy_policy says so
+        if not self._edits_pending:
+            return True
+        if self.fuzzy_policy == "wait":
+            self._build_edit_indexes()
+            return True
+        self._build_edit_indexes(background=True)
+        return False
+
+    def _symspell_depths(self):
+        # A word of n chars needs the largest limit of any query term it can
+        # be within that limit of; limits above symspell_max_distance never
+        # reach SymSpell.find(). Words past 64 chars get the depth of 63-char
+        # ones.
+        cap = self.symspell_max_distance
+        depths = []
+        for n in range(64):
+            depth = 1
+            for m in range(max(1, n - cap), n + cap + 1):
+                k = self._max_edits_for_length(m)
+                if abs(m - n) <= k:
+                    depth = max(depth, k)
+            depths.append(min(cap, depth))
+        return depths
+
+    def _init_write_state(self, deleted):
+        self.deleted = set(deleted)
+        self._tombstones = set()
+        self._write_lock = threading.RLock()
+        self._compaction = None
+        self._edits_build = None
+
+    def _init_caches(self):
+        # entries are keyed by the index generation, bumped on every write
+        self._generation = 0
+        self._cache = LRUCache(self.cache_cost)
+        self._last_prefix = None
+        # built by the first infix search, dropped when terms come or go
+        self._suffix_array = None
+
+    def _invalidate_caches(self):
+        self._generation += 1
+        self._cache.clear()
+        self._last_prefix = None
+
+    def _ensure_writable(self):
+        # a frozen term trie or a memory-mapped index is read-only; thaw it
+        # on the first write
+        if isinstance(self.word_trie, DAWG):
+            self.word_trie = self.word_trie.thaw()
+        if not isinstance(self.index, storage.MappedIndex):
+            return
+        records = list(self.records)
+        self.doc_lengths = array("I", self.doc_lengths)
+        index = {term: postings.copy() for term, postings in self.index.items()}
+        word_trie = Trie()
+        for term in index:
+            word_trie.insert(term)
+        if isinstance(self.edits_lev, storage.MappedBKTree):
+            self.edits_lev = self.edits_lev.thaw()
+            self.edits_3 = self.edits_3.thaw()
+        self.records, self.index, self.word_trie = records, index, word_trie
+        self._mmap = None
+
+    def _check_live(self, doc_id):
+        if not 0 <= doc_id < len(self.records) or doc_id in self.deleted:
+            raise KeyError(doc_id)
+
+    def add_records(self, records):
+        records = records if isinstance(records, list) else list(records)
+        with self._write_lock:
+            self._ensure_writable()
+            start = len(self.records)
+            self.records.extend(records)
+            self._index(records, start)
+            self._invalidate_caches()
+            return range(start, len(self.records))
+
+    def delete(self, doc_id):
+        with self._write_lock:
+            self._check_live(doc_id)
+            self.deleted.add(doc_id)
+            self._tombstones.add(doc_id)
+            self._invalidate_caches()
+            if len(self._tombstones) > self.compaction_threshold * len(self.records):
+                self.compact(background=True)
+
+    def update(self, doc_id, record):
+        with self._write_lock:
+            self._ensure_writable()
+            self._check_live(doc_id)
+            old_record = self.records[doc_id]
+            for token in self._group_occurrences(self.scan(old_record)):
+                self.index[token].remove(doc_id)
+            # terms left without postings linger in the trie and BK-trees until compaction
+            self.records[doc_id] = record
+            self._index_record(doc_id, record)
+            self._invalidate_caches()
+
+    def freeze(self):
+        # Replaces the term trie by a minimized DAWG, a fraction of its size,
+        # for indexes that are searched rather than written to.
+        with self._write_lock:
+            if isinstance(self.word_trie, Trie):
+                self.word_trie = self.word_trie.freeze()
+
+    def compact(self, background=False):
+        if background:
+            if self._compaction is None or not self._compaction.is_alive():
+                self._compaction = threading.Thread(target=self.compact, daemon=True)
+                self._compaction.start()
+            return
+
+        with self._write_lock:
+            self._ensure_writable()
+            tombstones = self._tombstones
+            index = {}
+            for token, postings in self.index.items():
+                if tombstones:
+                    postings = postings.without(tombstones)
+                if postings:
+                    index[token] = postings
+
+            if len(index) < len(self.index):
+                self._suffix_array = None
+                word_trie = Trie()
+                edits_lev, edits_3 = (None, None) if self._edits_pending else self._new_edit_indexes()
+                for token in index:
+                    self._insert_prefixes(token, word_trie, edits_lev, edits_3)
+                    word_trie.insert(token)
+                self.word_trie, self.edits_lev, self.edits_3 = word_trie, edits_lev, edits_3
+
+            for doc_id in tombstones:
+                self.records[doc_id] = None
+            # searches running concurrently keep filtering with the old tombstones
+            self.index = index
+            self._tombstones = set()
+            self._invalidate_caches()
+
+    def stats(self):
+        # Counts and estimated memory of the index's structures. "bytes" and
+        # "mapped_bytes" hold memory.sizeof of each, in the listed order;
+        # objects shared between structures, like the term strings, count
+        # with the first. Walks every structure, so it takes a while on large
+        # indexes, and waits for writers and a background fuzzy build.
+        with self._write_lock:
+            n_postings = n_occurrences = 0
+            for _, postings in self.index.items():
+                n_postings += len(postings)
+                n_occurrences += len(postings.words)
+
+            structures = [
+                ("records", self.records),
+                ("doc_lengths", self.doc_lengths),
+                ("postings", self.index),
+                ("trie", self.word_trie),
+                ("edits_lev", self.edits_lev),
+                ("edits_3", self.edits_3),
+                ("suffix_array", self._suffix_array),
+                ("cache", self._cache),
+            ]
+            heap, mapped = {}, {}
+            seen = set()
+            for name, structure in structures:
+                if structure is not None:
+                    heap[name], mapped[name] = memory.sizeof(structure, seen)
+
+            return {
+                "records": len(self.records),
+                "deleted": len(self.deleted),
+                "terms": len(self.index),
+                "postings": n_postings,
+                "occurrences": n_occurrences,
+                "trie_nodes": self.word_trie.node_count(),
+                "fuzzy_engine": self.fuzzy_engine,
+                "fuzzy_ready": self.fuzzy_ready(),
+                "edits_lev": self._edits_stats(self.edits_lev),
+                "edits_3": self._edits_stats(self.edits_3),
+                "bytes": heap,
+                "mapped_bytes": mapped,
+            }
+
+    def _edits_stats(self, edits):
+        if edits is None:
+            return None
+        if isinstance(edits, SymSpell):
+            return {"words": len(edits), "variants": len(edits.variants)}
+        return {"nodes": len(edits), "depths": dict(sorted(edits.depths().items()))}
+
+    def memory_report(self):
+        # stats() as text
+        stats = self.stats()
+        lines = [
+            "%d records (%d deleted), %d terms, %d postings, %d occurrences" % (
+                stats["records"], stats["deleted"], stats["terms"], stats["postings"], stats["occurrences"],
+            ),
+            "%d trie nodes" % stats["trie_nodes"],
+        ]
+        for name in ("edits_lev", "edits_3"):
+            edits = stats[name]
+            if edits is None:
+                state = "pending" if not stats["fuzzy_ready"] else "none"
+                lines.append("%s: %s (%s engine)" % (name, state, stats["fuzzy_engine"]))
+            elif "depths" in edits:
+                depths = " ".join("%d:%d" % item for item in edits["depths"].items())
+                lines.append("%s: %d nodes, by depth %s" % (name, edits["nodes"], depths))
+            else:
+                lines.append("%s: %d words, %d deletion variants" % (name, edits["words"], edits["variants"]))
+
+        lines.append("%-18s %12s %12s" % ("structure (MB)", "heap", "mapped"))
+        for name, heap in stats["bytes"].items():
+            lines.append("%-18s %12.2f %12.2f" % (name, heap / 1e6, stats["mapped_bytes"][name] / 1e6))
+        lines.append("%-18s %12.2f %12.2f" % (
+            "total", sum(stats["bytes"].values()) / 1e6, sum(stats["mapped_bytes"].values()) / 1e6,
+        ))
+        return "\n".join(lines)
+
+    # Tokens are runs of letters or runs of digits; everything else,
+    # including "_", separates them. Subclasses may override the pattern
+    # or scan itself.
+    token_pattern = re.compile(r"[^\W\d_]+|\d+")
+
+    def scan(self, record):
+        # [(term, char_position, word_position)] in a single pass
+        filter = self.filter
+        return [
+            (filter(m.group()), m.start(), word_position)
+            for word_position, m in enumerate(self.token_pattern.finditer(record))
+        ]
 
     def tokenize(self, record):
-        #return re.split("\W+", record)
-        return [w for w in re.split("[-_/.?+&:\W]+|(\d+)", record) if w]
+        return self.token_pattern.findall(record)
 
     def filter(self, token):
         return token.lower()
 
-    def add_token_offsets(self, record, tokens):
-        terms = []
-        char_i = 0
-        for tok_i, token in enumerate(tokens):
-            assert char_i < len(record)
-            while not record[char_i:].startswith(token):
-                char_i += 1
-            token = self.filter(token)
-            terms.append( (token, RecordPosition(char_i, tok_i)) )
-            char_i += len(token)
-        return terms
-
-    def search(self, query, topn=10, fuzzy=False):
-        if fuzzy:
-            candidates = self._find_phrase_fuzzy(query)
+    def search(self, query, topn=10, fuzzy=False, formatter=formatters.ansi, infix=False, cancel=None, partial=None):
+        # Yields (edit distance, min_dist, record rendered by formatter), or
+        # Hit objects with formatter=None. With infix=True every query term
+        # matches anywhere inside an indexed term, see _match_infix().
+        #
+        # A CancelToken passed as cancel abandons the search when cancelled.
+        # partial, if given, is called with the results known so far each
+        # time a distance level is exhausted: they are final, later levels
+        # only append to them.
+        if infix:
+            if fuzzy:
+                raise ValueError("infix search cannot be fuzzy")
+            find_top = self._find_top_infix
         else:
-            candidates = self._find_phrase(query)
-
-        candidates.sort(key=lambda c: (c.edit_distance, c.min_dist))
-        candidates = candidates[:topn]
+            find_top = self._find_top
+        if cancel is not None or partial is not None:
+            find_top = self._controlled(find_top, cancel, partial, formatter)
+        if self.profiler is not None:
+            yield from self._search_profiled(query, topn, fuzzy, formatter, find_top)
+            return
+        candidates = find_top(query, topn, fuzzy)
 
         for c in candidates:
-            record = self.records[c.doc_id]
-            highlights = self._merge_highlights(c.highlights)
-            highlighted_record = self._highlight_record(record, highlights)
-            yield (c.edit_distance, c.min_dist, highlighted_record)
+            yield self._result(c, formatter)
+
+    def hits(self, query, topn=10, fuzzy=False, infix=False, cancel=None):
+        return list(self.search(query, topn, fuzzy, formatter=None, infix=infix, cancel=cancel))
+
+    def _controlled(self, find_top, cancel, partial, formatter):
+        def run(query, topn, fuzzy):
+            _control.cancel = cancel
+            if partial is not None:
+                _control.partial = lambda candidates: partial([self._result(c, formatter) for c in candidates])
+            try:
+                return find_top(query, topn, fuzzy)
+            finally:
+                _control.cancel = _control.partial = None
+        return run
 
+    def _search_profiled(self, query, topn, fuzzy, formatter, find_top):
+        # results are rendered up front, so that the caller's time is not
+        # counted as the query's
+        with self.profiler.query(query):
+            candidates = find_top(query, topn, fuzzy)
+            with self.profiler.stage("highlight"):
+                return [self._result(c, formatter) for c in candidates]
 
-    def _group_occurrences(self, occurrences):
-        d = collections.defaultdict(list)
-        for word, record_position in occurrences:
-            d[word].append(record_position)
+    def _stage(self, name):
+        profiler = self.profiler
+        return NO_STAGE if profiler is None else profiler.stage(name)
+
+    def _count(self, name, n=1):
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.count(name, n)
+
+    def search_many(self, queries, topn=10, fuzzy=False, executor=None, max_workers=None, chunk_size=1000,
+                    formatter=formatters.ansi):
+        # Same as [list(self.search(q, topn, fuzzy, formatter)) for q in
+        # queries], but terms shared between queries are expanded only once
+        # per batch. executor "thread" searches on a thread pool, "process"
+        # sends chunks of chunk_size queries to a process pool, each process
+        # holding its own copy of the index (a saved index is just reopened
+        # there). Hits cannot leave the worker processes: with formatter=None
+        # they come back as (doc_id, edit distance, min_dist, score) tuples.
+        queries = list(queries)
+        if executor == "process":
+            chunks = [queries[i:i + chunk_size] for i in range(0, len(queries), chunk_size)]
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers, initializer=_init_batch_worker, initargs=(self,),
+            ) as pool:
+                results = []
+                for chunk_results in pool.map(
+                    _search_batch, chunks, itertools.repeat(topn), itertools.repeat(fuzzy), itertools.repeat(formatter),
+                ):
+                    results.extend(chunk_results)
+                return results
+        if executor not in (None, "thread"):
+            raise ValueError("unknown executor {!r}".format(executor))
+
+        query_terms = [self._query_terms(query, fuzzy) for query in queries]
+        batch = BatchTerms(self, collections.Counter(itertools.chain.from_iterable(query_terms)))
+
+        def run(query, terms):
+            def find_top(query, topn, fuzzy):
+                return self._find_top_terms(terms, topn, fuzzy, self._derive_term, batch.match)
+            try:
+                if self.profiler is not None:
+                    return self._search_profiled(query, topn, fuzzy, formatter, find_top)
+                return [self._result(c, formatter) for c in find_top(query, topn, fuzzy)]
+            finally:
+                batch.release(terms)
+
+        if executor is None:
+            return [run(query, terms) for query, terms in zip(queries, query_terms)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as pool:
+            return list(pool.map(run, queries, query_terms))
+
+    def _result(self, c, formatter=formatters.ansi):
+        hit = Hit(self, c)
+        if formatter is None:
+            return hit
+        return (c.edit_distance, c.min_dist, hit.render(formatter))
+
+
+    def _group_occurrences(self, scanned):
+        d = {}
+        for term, char_position, word_position in scanned:
+            positions = d.get(term)
+            if positions is None:
+                d[term] = positions = (array("I"), array("I"))
+            positions[0].append(char_position)
+            positions[1].append(word_position)
         return d
 
-    def _index(self, records):
-        for doc_id, record in enumerate(records):
-            tokens = self.tokenize(record)
-            occurrences = self.add_token_offsets(record, tokens)
-            for token, record_positions in self._group_occurrences(occurrences).items():
-                for i in range(1, len(token)):
-                    prefix = token[:i + 1]
-                    if not self.word_trie.is_prefix(prefix):
-                        self.edits_lev.insert(prefix)
-                        if len(prefix) == 3:
-                            self.edits_3.insert(prefix)
-
-                if token not in self.index:
-                    self.word_trie.insert(token)
-                    self.index[token] = []
-                self.index[token].append((doc_id, record_positions))
+    def _index(self, records, start=0):
+        for doc_id, record in enumerate(records, start):
+            self._index_record(doc_id, record)
+
+    def _index_record(self, doc_id, record):
+        scanned = self.scan(record)
+        if doc_id < len(self.doc_lengths):
+            self.doc_lengths[doc_id] = len(scanned)
+        else:
+            self.doc_lengths.append(len(scanned))
+        for token, (chars, words) in self._group_occurrences(scanned).items():
+            if token not in self.index:
+                self._suffix_array = None
+                self._insert_prefixes(token, self.word_trie, self.edits_lev, self.edits_3)
+                self.word_trie.insert(token)
+                self.index[token] = PostingsList()
+            self.index[token].insert(doc_id, chars, words)
+
+    def _insert_prefixes(self, token, word_trie, edits_lev, edits_3):
+        if edits_lev is None:
+            return
+        prefixes = [token[:i + 1] for i in range(1, len(token)) if not word_trie.is_prefix(token[:i + 1])]
+        edits_lev.insert_many(prefixes)
+        if edits_3 is not None:
+            edits_3.insert_many(prefix for prefix in prefixes if len(prefix) == 3)
+
+    def _max_edits(self, word):
+        return self._max_edits_for_length(len(word))
+
+    def _max_edits_for_length(self, n):
+        if n <= 4:
+            return 1
+        elif n <= 7:
+            return 2
+        else:
+            return 3
 
     def _find_derived_words(self, word, is_prefix):
-        use_levenshtein = True
-        if is_prefix:
-            if len(word) <= 2:
-                return ((0, w) for w in self.word_trie.descendants_or_self(word))
-            if len(word) == 3:
-                derived_words = self.edits_3.find(word, 1)
-                use_levenshtein = False
-
-        if use_levenshtein:
-            if len(word) <= 4:
-                d = 1
-            elif len(word) <= 7:
-                d = 2
+        key = ("derived", self._generation, word, is_prefix)
+        derived_words = self._cache.get(key)
+        if derived_words is None:
+            derived_words = list(self._find_derived_words_uncached(word, is_prefix))
+            self._cache.put(key, derived_words, CACHE_ENTRY_BYTES + CACHE_WORD_BYTES * len(derived_words))
+        self._count("derived_words", len(derived_words))
+        if self.max_expansions is not None and len(derived_words) > self.max_expansions:
+            derived_words = self._prune_derived_words(derived_words)
+        return derived_words
+
+    def _prune_derived_words(self, derived_words):
+        # document frequencies come from the postings headers, the postings
+        # themselves are not decoded
+        ranked = sorted(derived_words, key=lambda dw: (dw[0], -self._doc_freq(dw[1])))
+        self._count("pruned_words", len(ranked) - self.max_expansions)
+        return ranked[:self.max_expansions]
+
+    def _doc_freq(self, term):
+        # documents containing term, deleted ones included until compaction
+        postings = self.index.get(term)
+        return 0 if postings is None else len(postings)
+
+    def _collection_stats(self):
+        # (number of live records, their total length in tokens)
+        key = ("collection", self._generation)
+        stats = self._cache.get(key)
+        if stats is None:
+            lengths = self.doc_lengths
+            n = len(self.records) - len(self.deleted)
+            total = sum(lengths) - sum(lengths[doc_id] for doc_id in self.deleted)
+            stats = (n, total)
+            self._cache.put(key, stats, CACHE_ENTRY_BYTES)
+        return stats
+
+    def _collection_terms(self, query, fuzzy, infix=False):
+        # (live records, their total length, document frequency of every
+        # query term) as BM25 sees them; ShardedIndex sums these over its
+        # shards and passes them back as collection
+        if infix:
+            terms, derive, match_term = self._query_terms(query, False), self._derive_infix, self._match_infix
+            fuzzy = False
+        else:
+            terms, derive, match_term = self._query_terms(query, fuzzy), self._derive_term, self._match_term
+        doc_freqs = []
+        for t, p in terms:
+            derived = derive(t, p, fuzzy)
+            postings = [self.index.get(w) for _, w in derived[0]]
+            postings = [pl for pl in postings if pl]
+            if len(postings) == 1:
+                doc_freqs.append(self._live_doc_freq(postings[0]))
             else:
-                d = 3
+                doc_freqs.append(match_term(t, p, fuzzy, derived).doc_freq)
+        return self._collection_stats() + (doc_freqs,)
+
+    def _live_doc_freq(self, postings):
+        # documents of postings not deleted, without decoding all of it
+        return len(postings) - sum(1 for _ in postings.probe(sorted(self._tombstones)))
+
+    def _find_derived_words_uncached(self, word, is_prefix):
+        if is_prefix and len(word) <= 2:
+            with self._stage("trie"):
+                return [(0, w) for w in self.word_trie.descendants_or_self(word)]
+        if self.fuzzy_engine != "automaton" and not self._edit_indexes_ready():
+            with self._stage("trie"):
+                if is_prefix:
+                    return [(0, w) for w in self.word_trie.descendants_or_self(word)]
+                return [(0, word)]
 
-            derived_words = self.edits_lev.find(word, d)
-            # TODO check case: d == 1
+        limit = 1 if is_prefix and len(word) == 3 else self._max_edits(word)
+        if self.fuzzy_engine == "automaton" or (
+            self.fuzzy_engine == "symspell" and limit > self.edits_lev.max_distance
+        ):
+            with self._stage("trie"):
+                return list(self._find_derived_words_automaton(word, is_prefix))
+
+        stats = None if self.profiler is None else {}
+        if self.fuzzy_engine == "symspell":
+            with self._stage("symspell"):
+                derived_words = self.edits_lev.find(word, limit, stats)
+                if is_prefix and len(word) == 3:
+                    # what edits_3 holds: between 3-char words, Levenshtein
+                    # distance 1 is Hamming distance 1
+                    derived_words = [(d, w) for d, w in derived_words if len(w) == 3]
+            if stats:
+                self._count("symspell_probes", stats["probes"])
+                self._count("symspell_verified", stats["nodes"])
+        else:
+            with self._stage("bktree"):
+                if is_prefix and len(word) == 3:
+                    derived_words = list(self.edits_3.find(word, limit, stats))
+                else:
+                    derived_words = list(self.edits_lev.find(word, limit, stats))
+                    # TODO check case: d == 1
+            if stats:
+                # one distance_fn call per visited node
+                self._count("bk_nodes", stats["nodes"])
 
         if is_prefix:
-            min_dists = {}
-            for d, w in derived_words:
-                descs = self.word_trie.descendants_or_self(w)
-                for desc in descs:
-                    if desc not in min_dists:
-                        min_dists[desc] = d
-                    else:
-                        min_dists[desc] = min(min_dists[desc], d)
-            derived_words = ((d, desc) for desc, d in min_dists.items())
+            with self._stage("trie"):
+                min_dists = {}
+                for d, w in derived_words:
+                    descs = self.word_trie.descendants_or_self(w)
+                    for desc in descs:
+                        if desc not in min_dists:
+                            min_dists[desc] = d
+                        else:
+                            min_dists[desc] = min(min_dists[desc], d)
+                derived_words = [(d, desc) for desc, d in min_dists.items()]
 
         return derived_words
 
-    def _find_one(self, word, prefix, edit_distance):
-        docs_found = self.index.get(word, [])
-        result = []
-        for doc_id, record_positions in docs_found:
-            highlights = [
-                (rp.char_position, rp.char_position + len(prefix))
-                for rp in record_positions
-            ]
-            cnd = Candidate(doc_id, edit_distance, record_positions, highlights)
-            result.append(cnd)
+    def _find_derived_words_automaton(self, word, is_prefix):
+        # Mirrors the BK-trees: they hold prefixes of two or more chars keyed
+        # by their initial, and edits_3 only 3-char prefixes. Between equal
+        # length strings a single edit is a substitution, so Levenshtein
+        # distance 1 is the same as Hamming distance 1 there.
+        if is_prefix and len(word) == 3:
+            return self.word_trie.fuzzy_find(word, 1, prefix=True, exact_prefix=1, min_len=3, max_len=3)
+        return self.word_trie.fuzzy_find(word, self._max_edits(word), prefix=is_prefix, exact_prefix=1, min_len=2)
 
-        return result
+    def _query_terms(self, query, fuzzy):
+        # queries go through the same tokenizer and filter as records
+        tokens = [term for term, _, _ in self.scan(query)]
+        if not fuzzy or not tokens:
+            return [(token, False) for token in tokens]
+        is_last_prefix = query[-1] != " "
+        return [(token, is_last_prefix and i == len(tokens) - 1) for i, token in enumerate(tokens)]
 
-    def _find_one_fuzzy(self, word, is_prefix=False):
-        derived_words = self._find_derived_words(word, is_prefix)
+    def _derive_term(self, token, is_prefix, fuzzy):
+        # (derived words, None) of a query term, see _match_words()
+        if not fuzzy:
+            return [(0, token)], None
+        return self._find_derived_words(token, is_prefix), None
 
-        result = []
-        for d, w in derived_words:
-            candidates = self._find_one(w, word, d)
-            result.extend(candidates)
+    def _derive_infix(self, token, is_prefix, fuzzy):
+        # (derived words, offsets) of every term containing token. Finding
+        # token inside a term rather than at its start counts as one edit,
+        # so that whole words and prefixes rank first.
+        key = ("infix_offsets", self._generation, token)
+        offsets = self._cache.get(key)
+        if offsets is None:
+            with self._stage("suffixarray"):
+                offsets = self._ensure_suffix_array().find(token)
+            self._cache.put(key, offsets, CACHE_ENTRY_BYTES + CACHE_WORD_BYTES * len(offsets))
+        derived_words = [(0 if offset == 0 else 1, term) for term, offset in offsets.items()]
+        self._count("derived_words", len(derived_words))
+        if self.max_expansions is not None and len(derived_words) > self.max_expansions:
+            derived_words = self._prune_derived_words(derived_words)
+        return derived_words, offsets
 
-        d = collections.defaultdict(list)
-        for cnd in result:
-            d[cnd.doc_id].append(cnd)
+    def _match_term(self, token, is_prefix, fuzzy, derived):
+        key = ("match", self._generation, token, is_prefix, fuzzy, self.max_expansions)
+        match = self._cache.get(key)
+        if match is None:
+            match = self._match_words(token, *derived)
+            self._cache.put(key, match, CACHE_ENTRY_BYTES + CACHE_DOC_BYTES * len(match.distances))
+        return match
 
-        # group candidates by doc_id
-        result = []
-        for doc_id, cnds in d.items():
-            edit_distance = min(c.edit_distance for c in cnds)
-            last_occurrences = sum([c.last_occurrences for c in cnds], []) # TODO remove duplicate occurrences? are there any?
-            highlights = sum([c.highlights for c in cnds], [])
-            c = Candidate(doc_id, edit_distance, last_occurrences, highlights)
-            result.append(c)
+    def _match_infix(self, token, is_prefix, fuzzy, derived):
+        key = ("infix", self._generation, token, self.max_expansions)
+        match = self._cache.get(key)
+        if match is None:
+            match = self._match_words(token, *derived)
+            self._cache.put(key, match, CACHE_ENTRY_BYTES + CACHE_DOC_BYTES * len(match.distances))
+        return match
 
-        result.sort(key=lambda cnd: cnd.doc_id)
+    def _ensure_suffix_array(self):
+        suffix_array = self._suffix_array
+        if suffix_array is None:
+            suffix_array = self._suffix_array = SuffixArray(self.index)
+        return suffix_array
 
-        return result
+    def _match_words(self, token, derived_words, offsets=None):
+        # the TermMatch of token from the postings of its derived words;
+        # offsets, for infix matches, holds where token starts in each word
+        with self._stage("postings"):
+            tombstones = self._tombstones
+            match = TermMatch(len(token), None if offsets is None else {})
+            distances, occurrences = match.distances, match.occurrences
+            cancel = getattr(_control, "cancel", None)
+            for d, w in derived_words:
+                _check_cancelled(cancel)
+                postings = self.index.get(w)
+                if not postings:
+                    continue
+                if offsets is not None:
+                    match.shifts[postings] = offsets[w]
+                cursor = postings.cursor()
+                while cursor.next():
+                    doc_id = cursor.doc_id
+                    if doc_id in tombstones:
+                        continue
+                    occurrences[doc_id].append((postings, cursor.start, cursor.end))
+                    if d < distances.get(doc_id, d + 1):
+                        distances[doc_id] = d
+            match.doc_freq = len(distances)
+            self._finish_match(match)
+        self._count("postings_docs", len(occurrences))
+        return match
 
-    def _find_phrase(self, query):
-        tokens = self.tokenize(query)
-        if not tokens:
-            return []
+    def _probe_words(self, token, derived, doc_ids):
+        # The TermMatch of token restricted to doc_ids, sorted and live:
+        # each derived word's postings is leapfrogged to them through its
+        # skip entries rather than decoded whole as by _match_words().
+        derived_words, offsets = derived
+        with self._stage("postings"):
+            match = TermMatch(len(token), None if offsets is None else {})
+            distances, occurrences = match.distances, match.occurrences
+            cancel = getattr(_control, "cancel", None)
+            found = []
+            for d, w in derived_words:
+                _check_cancelled(cancel)
+                postings = self.index.get(w)
+                if not postings:
+                    continue
+                found.append(postings)
+                if offsets is not None:
+                    match.shifts[postings] = offsets[w]
+                for doc_id, start, end in postings.probe(doc_ids):
+                    occurrences[doc_id].append((postings, start, end))
+                    if d < distances.get(doc_id, d + 1):
+                        distances[doc_id] = d
+            if len(found) == 1:
+                match.doc_freq = self._live_doc_freq(found[0])
+            self._finish_match(match)
+        self._count("postings_docs", len(occurrences))
+        return match
 
-        candidates = self._find_one(tokens[0], tokens[0], 0)
-        for token in tokens[1:]:
-            new_candidates = self._find_one(token, token, 0)
-            candidates = self._merge(candidates, new_candidates)
+    def _finish_match(self, match):
+        for doc_id, d in match.distances.items():
+            match.levels[d].append(doc_id)
+        # cached matches are shared, so drop the defaultdicts' auto-insertion
+        match.levels = dict(match.levels)
+        match.occurrences = dict(match.occurrences)
 
-        return candidates
+    def _level_combinations(self, matches, total):
+        if len(matches) == 1:
+            if total in matches[0].levels:
+                yield (total,)
+            return
+        for d in matches[0].levels:
+            if d <= total:
+                for rest in self._level_combinations(matches[1:], total - d):
+                    yield (d,) + rest
+
+    def _find_top(self, query, topn, fuzzy, collection=None):
+        with self._stage("tokenize"):
+            terms = self._query_terms(query, fuzzy)
+        return self._find_top_terms(terms, topn, fuzzy, self._derive_term, self._match_term, collection)
 
-    def _find_phrase_fuzzy(self, query):
-        tokens = self.tokenize(query)
-        if not tokens:
+    def _find_top_infix(self, query, topn, fuzzy=False, collection=None):
+        with self._stage("tokenize"):
+            terms = self._query_terms(query, fuzzy=False)
+        return self._find_top_terms(terms, topn, False, self._derive_infix, self._match_infix, collection)
+
+    def _find_top_terms(self, terms, topn, fuzzy, derive, match_term, collection=None):
+        # The topn of all documents matching every term, ordered by total
+        # edit distance, then the summed min_dist of neighbouring terms, then
+        # doc id (with ranking "bm25", by descending score before doc id).
+        # Documents are visited by increasing total edit distance and the
+        # search stops as soon as topn candidates are known at the current
+        # distance. _check_ranking() below compares this to sorting them all.
+        # collection, from _collection_terms(), overrides the statistics
+        # BM25 scores with.
+        if topn is not None and topn <= 0:
             return []
+        cancel = getattr(_control, "cancel", None)
+        derived = []
+        for t, p in terms:
+            _check_cancelled(cancel)
+            derived.append(derive(t, p, fuzzy))
+        probed = self._probed_terms(derived)
 
+        matches = [None] * len(terms)
+        for i, (t, p) in enumerate(terms):
+            if i not in probed:
+                _check_cancelled(cancel)
+                matches[i] = match_term(t, p, fuzzy, derived[i])
+        if probed:
+            # the documents matching all decoded terms, driven by the rarest
+            decoded = sorted((m for m in matches if m is not None), key=lambda m: len(m.distances))
+            doc_ids = sorted(
+                doc_id for doc_id in decoded[0].distances
+                if all(doc_id in m.distances for m in decoded[1:])
+            )
+            for i in probed:
+                if not doc_ids:
+                    return []
+                matches[i] = self._probe_words(terms[i][0], derived[i], doc_ids)
+                doc_ids = sorted(matches[i].distances)
+        if not matches or not all(m.distances for m in matches):
+            return []
+        with self._stage("rank"):
+            return self._rank(terms, matches, topn, fuzzy, collection)
 
-        is_last_prefix = query[-1] != " "
-        candidates = self._find_one_fuzzy(tokens[0], is_prefix=is_last_prefix and len(tokens) == 1)
-        for i, token in enumerate(tokens[1:]):
-            new_candidates = self._find_one_fuzzy(token, is_prefix=is_last_prefix and i == len(tokens) - 2)
-            candidates = self._merge(candidates, new_candidates)
+    def _probed_terms(self, derived):
+        # Indices of the terms to probe rather than decode, see probe_ratio,
+        # the rarest first. Their document counts come from the postings
+        # headers. BM25 needs the document frequency of every term, known
+        # without decoding only for a single derived word.
+        if len(derived) < 2:
+            return []
+        sizes = []
+        for derived_words, _ in derived:
+            sizes.append([self._doc_freq(w) for _, w in derived_words])
+        totals = [sum(s) for s in sizes]
+        rarest = min(range(len(sizes)), key=totals.__getitem__)
+        probed = [
+            i for i, s in enumerate(sizes)
+            if i != rarest and totals[i] > self.probe_ratio * totals[rarest]
+            and (self.ranking != "bm25" or sum(1 for n in s if n) == 1)
+        ]
+        probed.sort(key=totals.__getitem__)
+        self._count("probed_terms", len(probed))
+        return probed
+
+    def _rank(self, terms, matches, topn, fuzzy, collection=None):
+        *leading, last = matches
+        prefix = self._phrase_prefix(terms[:-1], fuzzy, leading) if leading else None
+        scorer = self._bm25_scorer(matches, collection) if self.ranking == "bm25" else None
+        cancel = getattr(_control, "cancel", None)
+        partial = getattr(_control, "partial", None)
+
+        heap = []  # the best candidates so far, as negated keys
+        examined = 0
+        max_total = sum(max(m.levels) for m in matches)
+        for total in range(max_total + 1):
+            n_found = len(heap)
+            for levels in self._level_combinations(matches, total):
+                _check_cancelled(cancel)
+                last_docs = last.levels[levels[-1]]
+                if prefix is None:
+                    docs = ((doc_id, 0) for doc_id in last_docs)
+                else:
+                    prefix_docs = prefix.docs(levels[:-1])
+                    if len(prefix_docs) < len(last_docs):
+                        docs = ((doc_id, distance) for doc_id, distance in prefix_docs.items()
+                                if last.distances.get(doc_id) == levels[-1])
+                    else:
+                        docs = ((doc_id, prefix_docs[doc_id]) for doc_id in last_docs
+                                if doc_id in prefix_docs)
+
+                while True:
+                    # until the heap is full, no more than it still takes,
+                    # then just enough for NumPy, checking the heap between
+                    if topn is None:
+                        size = RANK_BATCH
+                    elif len(heap) < topn:
+                        size = min(RANK_BATCH, topn - len(heap))
+                    else:
+                        size = MIN_DISTS_NUMPY_BATCH
+                    batch = list(itertools.islice(docs, size))
+                    if not batch:
+                        break
+                    examined += len(batch)
+                    _check_cancelled(cancel)
+                    pairs = proximities = None
+                    if prefix is not None:
+                        if topn is None or len(heap) + len(batch) <= topn:
+                            # the heap keeps all of them: one min_dists() call
+                            pairs = self._proximity_pairs(leading[-1], last, batch)
+                            proximities = min_dists(pairs)
+                        elif numpy is not None and len(batch) >= MIN_DISTS_NUMPY_BATCH:
+                            # in one NumPy call if that pays for scoring some
+                            # documents the heap would turn away below
+                            batch = [(doc_id, distance) for doc_id, distance in batch
+                                     if not self._beaten(heap, topn, scorer, total, doc_id, distance)]
+                            pairs = self._proximity_pairs(leading[-1], last, batch)
+                            if _min_dists_pay_off(pairs):
+                                proximities = _min_dists_numpy(pairs)
+
+                    for i, (doc_id, distance) in enumerate(batch):
+                        if proximities is not None:
+                            distance += proximities[i]
+                        else:
+                            # cannot beat the worst kept candidate; the
+                            # proximity only adds to distance
+                            if self._beaten(heap, topn, scorer, total, doc_id, distance):
+                                continue
+                            if prefix is not None:
+                                xpositions, ypositions = pairs[i] if pairs is not None else (
+                                    leading[-1].positions(doc_id, "words"), last.positions(doc_id, "words"))
+                                distance += min_dist(xpositions, ypositions)
+                        if scorer is None:
+                            key = (-total, -distance, -doc_id)
+                        else:
+                            key = (-total, -distance, scorer(doc_id), -doc_id)
+                        if topn is None or len(heap) < topn:
+                            heapq.heappush(heap, key)
+                        elif key > heap[0]:
+                            heapq.heapreplace(heap, key)
+
+            if topn is not None and len(heap) >= topn:
+                break
+            if partial is not None and len(heap) > n_found and total < max_total:
+                partial(self._heap_candidates(heap, matches, scorer))
 
+        candidates = self._heap_candidates(heap, matches, scorer)
+        self._count("merge_comparisons", examined)
+        self._count("candidates", len(candidates))
         return candidates
 
-    def _merge(self, xs, ys):
-        cs = []
-        ix = iy = 0
-        while ix < len(xs) and iy < len(ys):
-            cndx, cndy = xs[ix], ys[iy]
-            if cndx.doc_id < cndy.doc_id:
-                ix += 1
-            elif cndx.doc_id > cndy.doc_id:
-                iy += 1
-            else:
-                xpositions = cndx.last_occurrences
-                ypositions = cndy.last_occurrences
-                edit_distance = cndx.edit_distance + cndy.edit_distance
+    @staticmethod
+    def _beaten(heap, topn, scorer, total, doc_id, distance):
+        # whether a full heap's worst candidate beats the document already;
+        # a score is only known once computed
+        if topn is None or len(heap) < topn:
+            return False
+        if scorer is None:
+            return (-total, -distance, -doc_id) < heap[0]
+        return (-total, -distance) < heap[0][:2]
+
+    @staticmethod
+    def _proximity_pairs(leading, last, batch):
+        return [(leading.positions(doc_id, "words"), last.positions(doc_id, "words")) for doc_id, _ in batch]
+
+    def _heap_candidates(self, heap, matches, scorer):
+        candidates = []
+        for key in sorted(heap, reverse=True):
+            total, distance, doc_id = key[0], key[1], -key[-1]
+            highlights = tuple(TermSpans(m, doc_id) for m in matches)
+            c = Candidate(doc_id, -total, matches[-1].positions(doc_id, "words"), highlights)
+            c.min_dist = -distance
+            if scorer is not None:
+                c.score = key[2]
+            candidates.append(c)
+        return candidates
 
-                c = Candidate(cndx.doc_id, edit_distance, ypositions, cndx.highlights + cndy.highlights)
-                c.min_dist = cndx.min_dist + min_dist(xpositions, ypositions)
-                cs.append(c)
-                ix, iy = ix + 1, iy + 1
+    def _bm25_scorer(self, matches, collection=None):
+        # A fuzzy term counts as the union of its derived words: its document
+        # frequency is the number of documents it matched, its term frequency
+        # in a document the occurrences of all of them.
+        if collection is None:
+            n, total_length = self._collection_stats()
+            doc_freqs = [m.doc_freq for m in matches]
+        else:
+            n, total_length, doc_freqs = collection
+        avg_length = total_length / n if n else 0.0
+        k1, b = self.bm25_k1, self.bm25_b
+        lengths = self.doc_lengths
+        idfs = [math.log(1 + (n - df + 0.5) / (df + 0.5)) for df in doc_freqs]
+
+        def score(doc_id):
+            norm = k1 * (1 - b + b * lengths[doc_id] / (avg_length or 1))
+            total = 0.0
+            for m, idf in zip(matches, idfs):
+                tf = sum(end - start for _, start, end in m.occurrences[doc_id])
+                total += idf * tf * (k1 + 1) / (tf + norm)
+            return total
+        return score
 
-        return cs
+    def _phrase_prefix(self, terms, fuzzy, matches):
+        # only reused for the very same (cached) matches, which rules out
+        # those of another generation or another kind of search
+        key = (tuple(terms), fuzzy)
+        last_prefix = self._last_prefix
+        if (
+            last_prefix is not None and last_prefix[0] == key
+            and all(a is b for a, b in zip(last_prefix[1].matches, matches))
+        ):
+            return last_prefix[1]
+        prefix = PhrasePrefix(matches)
+        self._last_prefix = (key, prefix)
+        return prefix
 
     def _merge_highlights(self, highlights):
         highlights = sorted(highlights)
@@ -244,7 +1368,7 @@ class Index:
         hlstart, hlend = 0, 0
         for start, end in highlights:
             if start <= hlend:
-                hlend = end
+                hlend = max(hlend, end)
             else:
                 if hlend > hlstart:
                     result.append( (hlstart, hlend) )
@@ -255,31 +1379,31 @@ class Index:
 
         return result
 
-    def _highlight_record(self, record, highlights):
-        normal = "\033[m"
-        bold = "\033[1m"
-
-        yellow_back = "\033[103m"
-        normal_back = "\033[49m"
-
-        result = []
-        last = 0
-        for start, end in highlights:
-            result.append(record[last:start])
-            result.append(yellow_back + record[start:end] + normal_back)
-            last = end
-        result.append(record[end:])
-        return "".join(result)
-
-    def _highlight_candidates(self, candidates):
-        r = []
-        for candidate in candidates:
-            #record = self.records[candidate.doc_id]
-            highlights = self._merge_highlights(candidate.highlights)
-            highlighted_record = self._highlight_record(record, highlights)
-            r.append( (candidate.edit_distance, candidate.min_dist, highlighted_record) )
-        return r
 
+def _check_ranking(index, queries, fuzzy):
+    # Compares _find_top() with the plain ranking it has to match: every
+    # document matching all terms, sorted by the full key.
+    for query in queries:
+        terms = index._query_terms(query, fuzzy)
+        matches = [index._match_term(t, p, fuzzy, index._derive_term(t, p, fuzzy)) for t, p in terms]
+        if not matches:
+            continue
+        scorer = index._bm25_scorer(matches) if index.ranking == "bm25" else None
+        keys = []
+        for doc_id in set(matches[0].distances).intersection(*(m.distances for m in matches[1:])):
+            total = sum(m.distances[doc_id] for m in matches)
+            distance = sum(
+                min_dist(x.positions(doc_id, "words"), y.positions(doc_id, "words"))
+                for x, y in zip(matches, matches[1:])
+            )
+            keys.append((total, distance, -scorer(doc_id) if scorer else 0.0, doc_id))
+        keys.sort()
+        for topn in (1, 3, 10, None):
+            found = [
+                (c.edit_distance, c.min_dist, -c.score if scorer else 0.0, c.doc_id)
+                for c in index._find_top(query, topn, fuzzy)
+            ]
+            assert found == keys[:topn], (query, topn, found, keys[:topn])
 
 
 if __name__ == "__main__":
@@ -333,3 +1457,18 @@ if __name__ == "__main__":
     found = index.search("taky i vysralis si", fuzzy=True)
     for edits, wd, f in found:
         print(edits, wd, f)
+
+    # words of the records in and out of order, cut short and misspelled
+    queries = []
+    for record in records:
+        words = index.tokenize(record)
+        queries.append(" ".join(words[:2]))
+        queries.append(" ".join(words[-1:-4:-1]))
+        queries.append(" ".join(words[1:3])[:-2])
+        queries.append(" ".join(word[:-1] + "x" if len(word) > 3 else word for word in words[:3]))
+    queries += [query + " " for query in queries]
+    for ranking in ("distance", "bm25"):
+        index.ranking = ranking
+        _check_ranking(index, queries, fuzzy=False)
+        _check_ranking(index, queries, fuzzy=True)
+    print("ranking checked on %d queries" % (4 * len(queries)))
@@ -0,0 +1,62 @@
+#!/usr/bin/python3
+
+import io
+import mmap
+import sys
+import threading
+import types
+
+# part of the program or the runtime rather than of any one structure
+_OPAQUE = (
+    type, types.FunctionType, types.BuiltinFunctionType, types.MethodType, types.ModuleType,
+    io.IOBase, threading.Thread,
+)
+
+
+def sizeof(obj, seen=None):
+    # Estimated (heap bytes, mapped bytes) of obj and everything it refers
+    # to: sys.getsizeof of every reachable object, walking containers and
+    # the __dict__/__slots__ of instances. Memoryviews and mmaps count their
+    # buffer as mapped, since the OS pages it in and out on its own. Objects
+    # in seen are skipped and the visited ones added, so passing one seen
+    # through several calls counts shared objects once, with the first.
+    if seen is None:
+        seen = set()
+    heap = mapped = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        heap += sys.getsizeof(obj)
+        if isinstance(obj, (str, bytes, bytearray, int, float, bool)) or obj is None:
+            continue
+        if isinstance(obj, memoryview):
+            mapped += obj.nbytes
+        elif isinstance(obj, mmap.mmap):
+            mapped += len(obj)
+        elif isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        elif not isinstance(obj, _OPAQUE):
+            stack.extend(_attributes(obj))
+    return heap, mapped
+
+def _attributes(obj):
+    values = []
+    d = getattr(obj, "__dict__", None)
+    if d is not None:
+        values.append(d)
+    for cls in type(obj).__mro__:
+        slots = cls.__dict__.get("__slots__", ())
+        for name in (slots,) if isinstance(slots, str) else slots:
+            if name in ("__dict__", "__weakref__"):
+                continue
+            try:
+                values.append(getattr(obj, name))
+            except AttributeError:
+                pass
+    return values
@@ -0,0 +1,308 @@
+#!/usr/bin/python3
+
+import bisect
+import random
+from array import array
+
+# every SKIP_INTERVAL-th document gets a skip entry
+SKIP_INTERVAL = 32
+
+
+def encode_varint(n, out):
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+def decode_varint(buf, i):
+    n = shift = 0
+    while True:
+        b = buf[i]
+        i += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, i
+        shift += 7
+
+
+class PostingsCursor:
+    # Decodes one document at a time. After next() returns True, the current
+    # document's occurrences are postings.chars[start:end] and
+    # postings.words[start:end].
+    __slots__ = "postings", "offset", "doc_id", "start", "end"
+
+    def __init__(self, postings):
+        self.postings = postings
+        self.offset = 0
+        self.doc_id = 0
+        self.start = self.end = 0
+
+    def next(self):
+        docs = self.postings.docs
+        if self.offset >= len(docs):
+            return False
+        delta, offset = decode_varint(docs, self.offset)
+        n_occurrences, self.offset = decode_varint(docs, offset)
+        self.doc_id += delta
+        self.start = self.end
+        self.end += n_occurrences
+        return True
+
+    def advance(self, target):
+        # Moves to the first document >= target, jumping over whole blocks of
+        # SKIP_INTERVAL documents through the skip entries. The cursor must
+        # already be on a document, see next().
+        if self.doc_id >= target:
+            return True
+
+        skips = self.postings.skips
+        lo, hi = 0, len(skips) // 4
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if skips[4 * mid] <= target:
+                lo = mid + 1
+            else:
+                hi = mid
+        i = 4 * (lo - 1)
+        if i >= 0 and skips[i + 1] >= self.offset:
+            # resume decoding right before the skipped-to document
+            self.offset = skips[i + 1]
+            self.doc_id = skips[i + 2]
+            self.end = skips[i + 3]
+
+        while self.doc_id < target:
+            if not self.next():
+                return False
+        return True
+
+
+class PostingsList:
+    # docs holds varint encoded (doc id delta, occurrence count) pairs; char
+    # and word positions of all occurrences are kept in parallel arrays.
+    # skips holds (doc id, docs offset, previous doc id, positions offset)
+    # quadruples that let a cursor start decoding at every SKIP_INTERVAL-th
+    # document.
+    __slots__ = "docs", "chars", "words", "skips", "n_docs", "last_doc"
+
+    def __init__(self, docs=None, chars=None, words=None, skips=None, n_docs=0, last_doc=-1):
+        self.docs = bytearray() if docs is None else docs
+        self.chars = array("I") if chars is None else chars
+        self.words = array("I") if words is None else words
+        self.skips = array("Q") if skips is None else skips
+        self.n_docs = n_docs
+        self.last_doc = last_doc
+
+    def __len__(self):
+        return self.n_docs
+
+    def __bool__(self):
+        return self.n_docs > 0
+
+    def cursor(self):
+        return PostingsCursor(self)
+
+    def __iter__(self):
+        cursor = PostingsCursor(self)
+        while cursor.next():
+            yield cursor.doc_id, cursor.start, cursor.end
+
+    def append(self, doc_id, chars, words):
+        assert doc_id > self.last_doc
+        if self.n_docs and self.n_docs % SKIP_INTERVAL == 0:
+            self.skips.extend((doc_id, len(self.docs), self.last_doc, len(self.words)))
+        encode_varint(doc_id - max(self.last_doc, 0), self.docs)
+        encode_varint(len(words), self.docs)
+        self.chars.extend(chars)
+        self.words.extend(words)
+        self.n_docs += 1
+        self.last_doc = doc_id
+
+    def insert(self, doc_id, chars, words):
+        # Splices the document in, or over its old entry: only the bytes and
+        # positions from there on move, and the next document's delta and
+        # the later skip entries are adjusted.
+        if doc_id <= self.last_doc:
+            self.remove(doc_id)
+        if doc_id > self.last_doc:
+            self.append(doc_id, chars, words)
+            return
+
+        offset, prev, next_doc, start, _, _ = self._seek(doc_id)
+        docs = self.docs
+        _, next_delta_end = decode_varint(docs, offset)
+        entry = bytearray()
+        encode_varint(doc_id - max(prev, 0), entry)
+        encode_varint(len(words), entry)
+        next_offset = offset + len(entry)
+        encode_varint(next_doc - doc_id, entry)
+        docs[offset:next_delta_end] = entry
+        self.chars[start:start] = array("I", chars)
+        self.words[start:start] = array("I", words)
+        self._shift_skips(doc_id, len(entry) - (next_delta_end - offset), len(words), next_offset, doc_id)
+        self.n_docs += 1
+
+    def remove(self, doc_id):
+        offset, prev, found, start, end, entry_end = self._seek(doc_id)
+        if found != doc_id:
+            return
+        docs = self.docs
+        entry = bytearray()
+        if entry_end < len(docs):
+            # the next document's delta now counts from prev
+            next_delta, replaced_end = decode_varint(docs, entry_end)
+            encode_varint(next_delta + doc_id - max(prev, 0), entry)
+        else:
+            replaced_end = entry_end
+        docs[offset:replaced_end] = entry
+        del self.chars[start:end]
+        del self.words[start:end]
+        self._shift_skips(doc_id, len(entry) - (replaced_end - offset), start - end, offset, max(prev, 0), drop=doc_id)
+        self.n_docs -= 1
+        if doc_id == self.last_doc:
+            # prev comes from a skip entry as 0 when no document is left
+            self.last_doc = prev if self.n_docs else -1
+
+    def _seek(self, doc_id):
+        # (docs offset, previous doc id or -1, doc id, positions start and
+        # end, docs offset after the entry) of the first document >= doc_id,
+        # starting from the last skip entry before it; doc id is None past
+        # the last document
+        skips = self.skips
+        lo, hi = 0, len(skips) // 4
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if skips[4 * mid] < doc_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo:
+            offset, prev, start = skips[4 * lo - 3:4 * lo]
+        else:
+            offset, prev, start = 0, -1, 0
+
+        docs = self.docs
+        while offset < len(docs):
+            delta, i = decode_varint(docs, offset)
+            n_occurrences, entry_end = decode_varint(docs, i)
+            current = max(prev, 0) + delta
+            if current >= doc_id:
+                return offset, prev, current, start, start + n_occurrences, entry_end
+            prev, offset, start = current, entry_end, start + n_occurrences
+        return offset, prev, None, start, start, offset
+
+    def _shift_skips(self, doc_id, docs_shift, positions_shift, next_offset, next_prev, drop=None):
+        # After an edit at doc_id: the entry of the next document now starts
+        # at next_offset and follows next_prev, the later ones move by the
+        # shifts, and the one of drop goes.
+        skips = self.skips
+        shifted = array("Q")
+        for i in range(0, len(skips), 4):
+            entry_doc, offset, prev, start = skips[i:i + 4]
+            if entry_doc == drop:
+                continue
+            if entry_doc > doc_id:
+                start += positions_shift
+                if prev <= doc_id:
+                    offset, prev = next_offset, next_prev
+                else:
+                    offset += docs_shift
+            shifted.extend((entry_doc, offset, prev, start))
+        self.skips = shifted
+
+    def probe(self, doc_ids):
+        # (doc_id, start, end) of those of the sorted doc_ids in the list,
+        # as for iteration. The cursor leapfrogs to each through the skip
+        # entries and the doc ids it jumps past are galloped over, so a
+        # short doc_ids costs little even against a long list.
+        cursor = PostingsCursor(self)
+        if not cursor.next():
+            return
+        i, n = 0, len(doc_ids)
+        while i < n:
+            if not cursor.advance(doc_ids[i]):
+                return
+            if cursor.doc_id == doc_ids[i]:
+                yield cursor.doc_id, cursor.start, cursor.end
+                i += 1
+            else:
+                i = gallop(doc_ids, cursor.doc_id, i + 1)
+
+    def without(self, doc_ids):
+        result = PostingsList()
+        for doc_id, chars, words in self._entries():
+            if doc_id not in doc_ids:
+                result.append(doc_id, chars, words)
+        return result
+
+    def copy(self):
+        return self.without(())
+
+    def _entries(self):
+        for doc_id, start, end in self:
+            yield doc_id, self.chars[start:end], self.words[start:end]
+
+
+def gallop(seq, target, lo=0, key=None):
+    # first index >= lo whose key is >= target, by exponential then binary
+    # search, so the cost depends on the distance skipped, not len(seq)
+    n = len(seq)
+    step = 1
+    hi = lo
+    while hi < n and (seq[hi] if key is None else key(seq[hi])) < target:
+        lo = hi + 1
+        hi += step
+        step *= 2
+    return bisect.bisect_left(seq, target, lo, min(hi, n), key=key)
+
+
+def _check_edits(postings, model, rng):
+    # Compares postings, after insert()/remove() calls, with a list appended
+    # from scratch out of model ({doc_id: (chars, words)}): the same
+    # entries, and every skip entry naming a document, its docs offset, the
+    # document before it and its positions offset as decoding finds them.
+    rebuilt = PostingsList()
+    for doc_id in sorted(model):
+        rebuilt.append(doc_id, *model[doc_id])
+    assert list(postings._entries()) == list(rebuilt._entries())
+    assert (postings.n_docs, postings.last_doc) == (rebuilt.n_docs, rebuilt.last_doc)
+
+    decoded = {}
+    cursor = PostingsCursor(postings)
+    prev, offset = 0, 0
+    while cursor.next():
+        decoded[cursor.doc_id] = (offset, prev, cursor.start)
+        prev, offset = cursor.doc_id, cursor.offset
+    skips = postings.skips
+    skip_docs = skips[::4]
+    assert list(skip_docs) == sorted(set(skip_docs))
+    for i in range(0, len(skips), 4):
+        assert decoded[skips[i]] == tuple(skips[i + 1:i + 4]), (skips[i:i + 4], decoded[skips[i]])
+
+    doc_ids = sorted(rng.sample(range(postings.last_doc + 2), min(50, postings.last_doc + 2)))
+    assert list(postings.probe(doc_ids)) == list(rebuilt.probe(doc_ids))
+
+def _occurrences(rng, first_char):
+    n = rng.randint(1, 3)
+    return array("I", range(first_char, first_char + n)), array("I", range(n))
+
+
+if __name__ == "__main__":
+    rng = random.Random(3)
+    for n_docs in (0, 1, SKIP_INTERVAL, 10 * SKIP_INTERVAL):
+        model = {}
+        postings = PostingsList()
+        for doc_id in sorted(rng.sample(range(3 * n_docs + 1), n_docs)):
+            model[doc_id] = _occurrences(rng, doc_id)
+            postings.append(doc_id, *model[doc_id])
+        for step in range(400):
+            doc_id = rng.randrange(3 * n_docs + 2)
+            if rng.random() < 0.5:
+                # new documents and new occurrences of present ones, some
+                # past the last document
+                model[doc_id] = _occurrences(rng, step)
+                postings.insert(doc_id, *model[doc_id])
+            else:
+                model.pop(doc_id, None)
+                postings.remove(doc_id)
+            _check_edits(postings, model, rng)
+    print("postings edits checked")
@@ -1,8 +1,13 @@
 #!/usr/bin/python3
 
+import argparse
 import sys
 import index
+import profiling
 import shutil
+import storage
+import threading
+import time
 
 def _find_getch():
     try:
@@ -32,32 +37,160 @@ def clear():
     sys.stderr.write("\x1b[2J\x1b[H")
     sys.stderr.flush()
 
-if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("need index_file argument!")
-        sys.exit(1)
 
-    index_file = sys.argv[1]
+class Screen:
+    # What the terminal shows: rows bottom-aligned above the prompt, redrawn
+    # in a single write. Lines end in \r\n since the tty may be in raw mode,
+    # getch() waiting, while the search worker draws. Results are only drawn
+    # while their query is still the one typed.
+
+    def __init__(self, n, rows):
+        self.n = n
+        self.lock = threading.Lock()
+        self.query = ""
+        self.rows = rows
+
+    def type(self, query, rows=None):
+        # echoes the typed query at once, over the results of the last one
+        with self.lock:
+            self.query = query
+            if rows is not None:
+                self.rows = rows
+            self._draw(rows is not None)
+
+    def show(self, query, found, done):
+        with self.lock:
+            if query != self.query:
+                return
+            self.rows = ["%s %s %s" % (d, wd, record) for d, wd, record in found[:self.n][::-1]]
+            self._draw(done)
+
+    def _draw(self, done):
+        prompt = ">> " + self.query if self.query else ">>"
+        if not done:
+            prompt += " ..."
+        lines = ["\x1b[2J\x1b[H"]
+        lines.extend("" for _ in range(self.n - len(self.rows)))
+        lines.extend(self.rows)
+        lines.append(prompt)
+        sys.stdout.write("\r\n".join(lines))
+        sys.stdout.flush()
+
+
+class SearchWorker(threading.Thread):
+    # Runs the TUI's searches off the input loop. submit() hands over the
+    # latest query, None for none, and cancels the search still running for
+    # an older one; a query is only searched once no newer one came in for
+    # debounce seconds. show(query, results, done) gets the partial results
+    # as they become known, then the final ones, unless superseded.
+
+    def __init__(self, idx, show, topn, infix=False, debounce=0.05):
+        super().__init__(daemon=True)
+        self.idx = idx
+        self.show = show
+        self.topn = topn
+        self.infix = infix
+        self.debounce = debounce
+        self.cond = threading.Condition()
+        self.query = None
+        self.submitted = 0.0
+        self.cancel = None
+        self.closed = False
+
+    def submit(self, query):
+        with self.cond:
+            self.query = query
+            self.submitted = time.monotonic()
+            if self.cancel is not None:
+                self.cancel.cancel()
+            self.cond.notify()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            if self.cancel is not None:
+                self.cancel.cancel()
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while True:
+                    if self.closed:
+                        return
+                    if self.query is None:
+                        self.cond.wait()
+                        continue
+                    remaining = self.submitted + self.debounce - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                query, self.query = self.query, None
+                cancel = self.cancel = index.CancelToken()
+
+            def partial(results):
+                if not cancel.cancelled:
+                    self.show(query, results, False)
+            try:
+                results = list(self.idx.search(
+                    query, topn=self.topn, fuzzy=not self.infix, infix=self.infix, cancel=cancel, partial=partial,
+                ))
+            except index.SearchCancelled:
+                continue
+            if not cancel.cancelled:
+                self.show(query, results, True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("index_file", help="records file, one record per line, or an index saved with --save")
+    parser.add_argument("--save", metavar="PATH", help="save the built index to PATH and exit")
+    parser.add_argument("--profile", action="store_true", help="print where searches spent their time on exit")
+    parser.add_argument("--stats", action="store_true", help="print the index's size and memory use per structure and exit")
+    parser.add_argument("--ranking", choices=["distance", "bm25"], default="distance",
+                        help="order results with equal edit distance and proximity by doc id or by BM25 score")
+    parser.add_argument("--max-expansions", type=int, metavar="N",
+                        help="expand a fuzzy term to at most N of the closest, most frequent words")
+    parser.add_argument("--infix", action="store_true", help="match query terms anywhere inside words, not fuzzily")
+    parser.add_argument("--fuzzy-build", choices=["eager", "lazy", "background"], default="eager",
+                        help="when to build the fuzzy search structures")
+    parser.add_argument("--fuzzy-policy", choices=["wait", "degrade"], default="wait",
+                        help="whether fuzzy searches wait for those structures or match exactly until they are built")
+    args = parser.parse_args()
+
+    index_file = args.index_file
+
+    if storage.is_index_file(index_file):
+        idx = index.Index.load(index_file, fuzzy_build=args.fuzzy_build)
+        records = idx.records
+    else:
+        with open(index_file, "r") as f:
+            idx = index.Index.from_stream((line.strip() for line in f), freeze=True, fuzzy_build=args.fuzzy_build)
+        records = idx.records
+
+    n_records = len(records)
+    idx.ranking = args.ranking
+    idx.max_expansions = args.max_expansions
+    idx.fuzzy_policy = args.fuzzy_policy
+    if args.profile:
+        idx.profiler = profiling.Profiler()
+    if args.stats:
+        print(idx.memory_report())
+    if args.save:
+        idx.save(args.save)
+        print("saved index of %s records to %s" % (n_records, args.save))
+    if args.stats or args.save:
+        sys.exit(0)
 
     term_size = shutil.get_terminal_size((80, 20))
     clear()
-
-    records = []
-    n_records = 0
-    with open(index_file, "r") as f:
-        for line in f:
-            n_records += 1
-            records.append(line.strip())
-
-    idx = index.Index(records)
     print("indexed %s records!" % n_records)
 
     n = term_size.lines + 1
-    for remaining_line in range(n - n_records):
-        print()
-    for record in records[:n]:
-        print(record)
-    print(">>")
+    first_records = list(records[:n])
+    screen = Screen(n, first_records)
+    worker = SearchWorker(idx, screen.show, n - 1, infix=args.infix)
+    worker.start()
+    screen.type("", first_records)
 
     query = ""
     while True:
@@ -69,18 +202,15 @@ if __name__ == "__main__":
         else:
             query += c
 
-        clear()
         if not query:
-            for remaining_line in range(n - n_records):
-                print()
-            for record in records[:n]:
-                print(record)
+            worker.submit(None)
+            screen.type("", first_records)
         else:
-            found = list(idx.search(query, topn=n-1, fuzzy=True))
-            for remaining_line in range(n - len(found)):
-                print()
-            for d, wd, record in found[:n][::-1]:
-                print(d, wd, record)
+            screen.type(query)
+            worker.submit(query)
+    worker.close()
+    print()
 
-        print(">>", query)
 
+    if idx.profiler is not None:
+        print(idx.profiler.report(), file=sys.stderr)
@@ -0,0 +1,146 @@
+#!/usr/bin/python3
+
+import collections
+import contextlib
+import threading
+import time
+
+# shared by every disabled stage, so that instrumented code pays one check
+NO_STAGE = contextlib.nullcontext()
+
+
+class Histogram:
+    # Counts values in power-of-two buckets: bucket i holds values in
+    # [2 ** (i - 1), 2 ** i), bucket 0 everything below 1.
+
+    def __init__(self):
+        self.buckets = collections.Counter()
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.buckets[max(0, int(value)).bit_length()] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, p):
+        # upper bound of the bucket holding the p-th percentile
+        if not self.count:
+            return None
+        rank = p / 100.0 * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(self.max, 2 ** bucket)
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+
+class QueryProfile:
+    # exclusive wall time per stage in seconds and counters of one query
+    __slots__ = "query", "stages", "counters", "total"
+
+    def __init__(self, query):
+        self.query = query
+        self.stages = collections.defaultdict(float)
+        self.counters = collections.Counter()
+        self.total = 0.0
+
+
+class Profiler:
+    # Opt-in instrumentation for Index: set index.profiler = Profiler() and
+    # every search records where its time went. Stages nest; a stage's time
+    # excludes the stages run inside it, so the stages of a query add up to
+    # its total. Stage times are aggregated into histograms in microseconds,
+    # counters as per-query values; the last history queries are kept whole.
+
+    def __init__(self, history=100):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.history = collections.deque(maxlen=history)
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.n_queries = 0
+            self.totals = Histogram()
+            self.stages = collections.defaultdict(Histogram)
+            self.counters = collections.defaultdict(Histogram)
+            self.history.clear()
+
+    @contextlib.contextmanager
+    def query(self, query):
+        if getattr(self.local, "profile", None) is not None:
+            # nested, e.g. search() called from search_many(); count once
+            yield self.local.profile
+            return
+        profile = self.local.profile = QueryProfile(query)
+        self.local.stack = []
+        start = time.perf_counter()
+        try:
+            with self.stage("other"):
+                yield profile
+        finally:
+            profile.total = time.perf_counter() - start
+            self.local.profile = None
+            self._record(profile)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        profile = getattr(self.local, "profile", None)
+        if profile is None:
+            yield
+            return
+        stack = self.local.stack
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = stack.pop()
+            profile.stages[name] += elapsed - nested
+            if stack:
+                stack[-1] += elapsed
+
+    def count(self, name, n=1):
+        profile = getattr(self.local, "profile", None)
+        if profile is not None:
+            profile.counters[name] += n
+
+    def _record(self, profile):
+        with self.lock:
+            self.n_queries += 1
+            self.totals.add(1e6 * profile.total)
+            for name, seconds in profile.stages.items():
+                self.stages[name].add(1e6 * seconds)
+            for name, n in profile.counters.items():
+                self.counters[name].add(n)
+            self.history.append(profile)
+
+    def report(self):
+        with self.lock:
+            lines = ["%d queries" % self.n_queries]
+            if not self.n_queries:
+                return lines[0]
+            # percentiles are bucket bounds, exact within a factor of two
+            lines.append("%-18s %8s %12s %10s %10s %10s" % ("stage (ms)", "queries", "total", "mean", "p50", "p99"))
+            rows = [("query", self.totals)] + sorted(self.stages.items(), key=lambda item: -item[1].total)
+            for name, h in rows:
+                lines.append("%-18s %8d %12.2f %10.3f %10.3f %10.3f" % (
+                    name, h.count, h.total / 1000, h.mean() / 1000, h.percentile(50) / 1000, h.percentile(99) / 1000,
+                ))
+            if self.counters:
+                lines.append("%-18s %8s %12s %10s %10s %10s" % ("counter", "queries", "total", "mean", "p50", "p99"))
+                for name, h in sorted(self.counters.items()):
+                    lines.append("%-18s %8d %12d %10.1f %10d %10d" % (
+                        name, h.count, h.total, h.mean(), h.percentile(50), h.percentile(99),
+                    ))
+            return "\n".join(lines)
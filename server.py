@@ -0,0 +1,216 @@
+#!/usr/bin/python3
+
+import argparse
+import asyncio
+import concurrent.futures
+import index
+import json
+import storage
+import sys
+import url_index
+import urllib.parse
+
+INDEX_CLASSES = {
+    "index": index.Index,
+    "url": url_index.UrlIndex,
+}
+
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    409: "Conflict",
+    504: "Gateway Timeout",
+}
+
+
+def load_index(path, index_cls):
+    if storage.is_index_file(path):
+        return index_cls.load(path)
+    with open(path, "r") as f:
+        return index_cls.from_stream(line.strip() for line in f)
+
+
+async def _read_request(reader):
+    # (method, target, version, headers) of the next request on the
+    # connection, None once the client hung up. Request bodies are ignored.
+    line = await reader.readline()
+    if not line:
+        return None
+    parts = line.decode("latin-1").split()
+    if len(parts) != 3:
+        raise ValueError("malformed request line")
+    method, target, version = parts
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length", 0))
+    if length:
+        await reader.readexactly(length)
+    return method, target, version, headers
+
+def _write_response(writer, status, payload, keep_alive):
+    body = json.dumps(payload).encode("utf-8")
+    head = "HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\nConnection: %s\r\n\r\n" % (
+        status, REASONS[status], len(body), "keep-alive" if keep_alive else "close",
+    )
+    writer.write(head.encode("latin-1") + body)
+
+
+class SearchServer:
+    # Serves one index over HTTP:
+    #
+    #   GET /search?q=QUERY&topn=10&fuzzy=1&infix=0&session=ID&timeout=SECONDS
+    #
+    # answers {"query": ..., "results": [{"doc_id", "distance", "min_dist",
+    # "score", "record", "highlights": [[start, end], ...]}]}. Searches run on a
+    # thread pool; a newer query with the same session id (one per search
+    # box, say) supersedes the one still running, which is answered with 409.
+    # A search that outlives its timeout is answered with 504. Either way the
+    # search is cancelled through its index.CancelToken and stops at its next
+    # check, freeing the thread.
+
+    def __init__(self, idx, timeout=2.0, max_workers=None, max_topn=1000):
+        self.index = idx
+        self.timeout = timeout
+        self.max_topn = max_topn
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+        self.sessions = {}
+        self.superseded = set()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await _read_request(reader)
+                except ValueError:
+                    _write_response(writer, 400, {"error": "malformed request"}, False)
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+                method, target, version, headers = request
+                status, payload = await self.respond(method, target)
+                connection = headers.get("connection", "").lower()
+                keep_alive = connection == "keep-alive" if version == "HTTP/1.0" else connection != "close"
+                _write_response(writer, status, payload, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, method, target):
+        url = urllib.parse.urlsplit(target)
+        if url.path != "/search":
+            return 404, {"error": "unknown path {}".format(url.path)}
+        if method != "GET":
+            return 405, {"error": "only GET is supported"}
+
+        params = urllib.parse.parse_qs(url.query, keep_blank_values=True)
+        def param(name, default=None):
+            values = params.get(name)
+            return values[-1] if values else default
+        try:
+            topn = int(param("topn", 10))
+            timeout = float(param("timeout", self.timeout))
+        except ValueError as e:
+            return 400, {"error": str(e)}
+        if not 0 < topn <= self.max_topn:
+            return 400, {"error": "topn must be between 1 and {}".format(self.max_topn)}
+        query = param("q", "")
+        fuzzy = param("fuzzy", "0").lower() in ("1", "true", "yes")
+        infix = param("infix", "0").lower() in ("1", "true", "yes")
+        if fuzzy and infix:
+            return 400, {"error": "infix search cannot be fuzzy"}
+        # a client may ask for less time, never for more
+        timeout = min(timeout, self.timeout)
+        return await self.search(query, topn, fuzzy, param("session"), timeout, infix)
+
+    async def search(self, query, topn, fuzzy, session, timeout, infix=False):
+        loop = asyncio.get_running_loop()
+        cancel = index.CancelToken()
+        task = asyncio.ensure_future(
+            loop.run_in_executor(self.executor, self._search, query, topn, fuzzy, infix, cancel),
+        )
+        if session is not None:
+            previous = self.sessions.get(session)
+            if previous is not None:
+                self.superseded.add(previous)
+                previous.cancel()
+            self.sessions[session] = task
+        try:
+            results = await asyncio.wait_for(task, timeout)
+        except asyncio.CancelledError:
+            cancel.cancel()
+            if task not in self.superseded:
+                raise
+            return 409, {"query": query, "error": "superseded by a newer query"}
+        except asyncio.TimeoutError:
+            cancel.cancel()
+            return 504, {"query": query, "error": "timed out after {}s".format(timeout)}
+        finally:
+            self.superseded.discard(task)
+            if session is not None and self.sessions.get(session) is task:
+                del self.sessions[session]
+        return 200, {"query": query, "results": results}
+
+    def _search(self, query, topn, fuzzy, infix=False, cancel=None):
+        return [
+            {
+                "doc_id": hit.doc_id,
+                "distance": hit.edit_distance,
+                "min_dist": hit.min_dist,
+                "score": hit.score,
+                "record": hit.record,
+                "highlights": hit.spans(),
+            }
+            for hit in self.index.hits(query, topn, fuzzy, infix, cancel)
+        ]
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+async def serve(server, host="127.0.0.1", port=8080, unix=None):
+    if unix is not None:
+        listener = await asyncio.start_unix_server(server.handle, path=unix)
+    else:
+        listener = await asyncio.start_server(server.handle, host, port)
+    async with listener:
+        await listener.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="answer search queries over HTTP with JSON results")
+    parser.add_argument("index_file", help="records file, one record per line, or an index saved with priblix.py --save")
+    parser.add_argument("--index-class", choices=sorted(INDEX_CLASSES), default="index")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--unix", metavar="PATH", help="listen on a unix socket instead of TCP")
+    parser.add_argument("--timeout", type=float, default=2.0, help="longest a single search may take, in seconds")
+    parser.add_argument("--workers", type=int, default=None, help="search threads")
+    parser.add_argument("--ranking", choices=["distance", "bm25"], default="distance")
+    parser.add_argument("--max-expansions", type=int, metavar="N")
+    args = parser.parse_args()
+
+    idx = load_index(args.index_file, INDEX_CLASSES[args.index_class])
+    idx.ranking = args.ranking
+    idx.max_expansions = args.max_expansions
+    server = SearchServer(idx, timeout=args.timeout, max_workers=args.workers)
+    where = args.unix or "http://%s:%d" % (args.host, args.port)
+    print("serving %d records on %s" % (len(idx.records), where), file=sys.stderr)
+    try:
+        asyncio.run(serve(server, args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
@@ -0,0 +1,177 @@
+#!/usr/bin/python3
+
+import concurrent.futures
+import formatters
+import heapq
+import index
+import itertools
+import json
+import os
+
+MANIFEST = "shards.json"
+
+
+def _build_shard(index_cls, records, index_kwargs, path=None):
+    shard = index_cls(records, **index_kwargs)
+    if path is None:
+        return shard
+    shard.save(path)
+    return path
+
+
+class ShardedRecords:
+    __slots__ = "shards", "starts"
+
+    def __init__(self, shards, starts):
+        self.shards = shards
+        self.starts = starts
+
+    def __len__(self):
+        return self.starts[-1] + len(self.shards[-1].records) if self.shards else 0
+
+    def __getitem__(self, doc_id):
+        if isinstance(doc_id, slice):
+            return [self[i] for i in range(*doc_id.indices(len(self)))]
+        if doc_id < 0:
+            doc_id += len(self)
+        if not 0 <= doc_id < len(self):
+            raise IndexError(doc_id)
+        shard_i = _shard_of(self.starts, doc_id)
+        return self.shards[shard_i].records[doc_id - self.starts[shard_i]]
+
+    def __iter__(self):
+        for shard in self.shards:
+            yield from shard.records
+
+
+def _shard_of(starts, doc_id):
+    lo, hi = 0, len(starts)
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if starts[mid] <= doc_id:
+            lo = mid
+        else:
+            hi = mid
+    return lo
+
+
+class ShardedIndex:
+    # Splits the records into contiguous doc id ranges, builds one index per
+    # range in a process pool and answers queries by merging the shards'
+    # top-n lists. Doc ids and result order match a single Index over all
+    # records. Built shards are pickled back to this process, or, given a
+    # directory, saved there by the workers and memory-mapped.
+
+    def __init__(self, records, n_shards=None, index_cls=index.Index, max_workers=None, directory=None, **index_kwargs):
+        records = records if isinstance(records, list) else list(records)
+        if n_shards is None:
+            n_shards = os.cpu_count() or 1
+        n_shards = max(1, min(n_shards, len(records)))
+
+        bounds = [len(records) * i // n_shards for i in range(n_shards + 1)]
+        self.starts = bounds[:-1]
+        chunks = [records[start:end] for start, end in zip(bounds, bounds[1:])]
+
+        paths = [None] * n_shards
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            paths = [os.path.join(directory, "shard%d.idx" % i) for i in range(n_shards)]
+
+        if n_shards == 1:
+            shards = [_build_shard(index_cls, chunks[0], index_kwargs, paths[0])]
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as pool:
+                futures = [
+                    pool.submit(_build_shard, index_cls, chunk, index_kwargs, path)
+                    for chunk, path in zip(chunks, paths)
+                ]
+                shards = [f.result() for f in futures]
+
+        if directory is not None:
+            with open(os.path.join(directory, MANIFEST), "w") as f:
+                json.dump({"starts": self.starts, "shards": [os.path.basename(p) for p in paths]}, f)
+            shards = [index_cls.load(path) for path in paths]
+
+        self.shards = shards
+        self.records = ShardedRecords(self.shards, self.starts)
+
+    @classmethod
+    def load(cls, directory, index_cls=index.Index):
+        with open(os.path.join(directory, MANIFEST)) as f:
+            manifest = json.load(f)
+        self = cls.__new__(cls)
+        self.starts = manifest["starts"]
+        self.shards = [index_cls.load(os.path.join(directory, name)) for name in manifest["shards"]]
+        self.records = ShardedRecords(self.shards, self.starts)
+        return self
+
+    def __len__(self):
+        return len(self.records)
+
+    def _collection_terms(self, query, fuzzy, infix):
+        # Index._collection_terms() of all shards together
+        n = total_length = 0
+        doc_freqs = None
+        for shard in self.shards:
+            shard_n, shard_length, shard_doc_freqs = shard._collection_terms(query, fuzzy, infix)
+            n += shard_n
+            total_length += shard_length
+            doc_freqs = shard_doc_freqs if doc_freqs is None else [a + b for a, b in zip(doc_freqs, shard_doc_freqs)]
+        return n, total_length, doc_freqs
+
+    def search(self, query, topn=10, fuzzy=False, formatter=formatters.ansi, infix=False, cancel=None, partial=None):
+        # As Index.search(), with doc ids counted over all shards. A shard
+        # not searched yet could still add results anywhere, so partial is
+        # only called while the last shard ranks, with what it has found so
+        # far merged into the other shards' results.
+        if infix and fuzzy:
+            raise ValueError("infix search cannot be fuzzy")
+        for shard_i, c in self._find_top(query, topn, fuzzy, infix, cancel, partial, formatter):
+            yield self._result(shard_i, c, formatter)
+
+    def hits(self, query, topn=10, fuzzy=False, infix=False, cancel=None):
+        return list(self.search(query, topn, fuzzy, formatter=None, infix=infix, cancel=cancel))
+
+    def _find_top(self, query, topn, fuzzy, infix, cancel, partial, formatter):
+        # [(shard index, candidate)] of the topn over all shards
+        control = index._control
+        control.cancel = cancel
+        try:
+            collection = None
+            if self.shards and self.shards[0].ranking == "bm25":
+                # every shard scores with the statistics of all records
+                collection = self._collection_terms(query, fuzzy, infix)
+            per_shard = []
+            for shard_i, (shard, start) in enumerate(zip(self.shards, self.starts)):
+                index._check_cancelled(cancel)
+                if partial is not None and shard_i == len(self.shards) - 1:
+                    control.partial = lambda candidates: partial([
+                        self._result(i, c, formatter)
+                        for i, c in self._merge(per_shard + [self._keyed(shard_i, candidates)], topn)
+                        if c.edit_distance <= candidates[-1].edit_distance
+                    ])
+                find_top = shard._find_top_infix if infix else shard._find_top
+                per_shard.append(self._keyed(shard_i, find_top(query, topn, fuzzy, collection)))
+            return self._merge(per_shard, topn)
+        finally:
+            control.cancel = control.partial = None
+
+    def _keyed(self, shard_i, candidates):
+        start = self.starts[shard_i]
+        return [(c.edit_distance, c.min_dist, -c.score, start + c.doc_id, shard_i, c) for c in candidates]
+
+    def _merge(self, per_shard, topn):
+        merged = heapq.merge(*per_shard, key=lambda r: r[:4])
+        return [(shard_i, c) for *_, shard_i, c in itertools.islice(merged, topn)]
+
+    def _result(self, shard_i, c, formatter):
+        if formatter is not None:
+            return self.shards[shard_i]._result(c, formatter)
+        # a Hit of this index: its record and spans are looked up through it
+        hit = index.Hit(self.shards[shard_i], c)
+        hit.index = self
+        hit.doc_id += self.starts[shard_i]
+        return hit
+
+    def _merge_highlights(self, highlights):
+        return self.shards[0]._merge_highlights(highlights)
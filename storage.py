@@ -0,0 +1,525 @@
+#!/usr/bin/python3
+
+import collections
+import json
+import mmap
+import os
+import struct
+import tempfile
+import threading
+from array import array
+from postings import PostingsList
+from trees.bktree import FlatBKTree
+from trees.trie import FuzzySearchMixin
+
+MAGIC = b"PRIBLIX\x00"
+VERSION = 3
+
+_HEADER = struct.Struct("<8sII")  # magic, version, number of sections
+_SECTION = struct.Struct("<16sQQ")  # name, offset, length
+_U64 = struct.Struct("<Q")
+_BK_NODE = struct.Struct("<HH")  # word length in bytes, number of children
+_BK_EDGE = struct.Struct("<HQ")  # distance, child offset
+
+
+def _cast_u64(buf):
+    return memoryview(buf).cast("B").cast("Q")
+
+def is_index_file(path):
+    try:
+        with open(path, "rb") as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+
+def _encode_strings(strings):
+    offsets = [0]
+    blob = bytearray()
+    for s in strings:
+        blob += s if isinstance(s, bytes) else s.encode("utf-8")
+        offsets.append(len(blob))
+    out = bytearray(_U64.pack(len(offsets) - 1))
+    out += struct.pack("<%dQ" % len(offsets), *offsets)
+    out += blob
+    return out
+
+def _encode_postings(postings_lists):
+    # Layout: docs, positions and skips lengths, a (docs offset, positions
+    # offset, number of docs, skips offset) row per term plus a sentinel row,
+    # the skip entries, the concatenated docs streams, then the char and word
+    # position arrays. Skip entries are relative to their own postings list.
+    table = array("Q")
+    skips = array("Q")
+    docs = bytearray()
+    chars = array("I")
+    words = array("I")
+    for postings in postings_lists:
+        table.extend((len(docs), len(chars), len(postings), len(skips)))
+        skips.extend(postings.skips)
+        docs += postings.docs
+        chars.extend(postings.chars)
+        words.extend(postings.words)
+    table.extend((len(docs), len(chars), 0, len(skips)))
+    docs += b"\x00" * (-len(docs) % 4)
+
+    out = bytearray(struct.pack("<QQQ", len(docs), len(chars), len(skips)))
+    out += table.tobytes()
+    out += skips.tobytes()
+    out += docs
+    out += chars.tobytes()
+    out += words.tobytes()
+    return out
+
+def _encode_bktree(tree):
+    # Nodes are laid out in preorder; every edge stores the absolute offset
+    # of the child node within the section so that lookups need no parsing.
+    # Works for BKTree (BKNode nodes) and FlatBKTree (node indices) alike; a
+    # MappedBKTree already is such a section.
+    if isinstance(tree, MappedBKTree):
+        return tree.buf
+    if isinstance(tree, FlatBKTree):
+        word_of, children_of = tree.words.__getitem__, tree.children
+    else:
+        word_of, children_of = (lambda node: node.word), (lambda node: list(node.children.items()))
+    nodes = []
+    roots = []
+    for initial, root in tree.roots.items():
+        roots.append((initial, len(nodes)))
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            children = children_of(node)
+            nodes.append((node, word_of(node).encode("utf-8"), children))
+            stack.extend(reversed([child for _, child in children]))
+
+    header = {"size": len(tree), "roots": [initial for initial, _ in roots]}
+    header = json.dumps(header).encode("utf-8")
+    base = 4 + len(header) + 8 * len(roots)
+
+    offsets = []
+    offset_of = {}
+    offset = base
+    for node, word, children in nodes:
+        offsets.append(offset)
+        offset_of[node] = offset
+        offset += _BK_NODE.size + len(word) + _BK_EDGE.size * len(children)
+
+    out = bytearray(struct.pack("<I", len(header)))
+    out += header
+    for _, node_i in roots:
+        out += _U64.pack(offsets[node_i])
+    for node, word, children in nodes:
+        out += _BK_NODE.pack(len(word), len(children))
+        out += word
+        for d, child in children:
+            out += _BK_EDGE.pack(d, offset_of[child])
+    return out
+
+
+class MappedStrings:
+    __slots__ = "n", "offsets", "blob"
+
+    def __init__(self, buf):
+        self.n = _U64.unpack_from(buf, 0)[0]
+        offsets_end = _U64.size * (self.n + 2)
+        self.offsets = _cast_u64(buf[_U64.size:offsets_end])
+        self.blob = buf[offsets_end:]
+
+    def __len__(self):
+        return self.n
+
+    def raw(self, i):
+        return bytes(self.blob[self.offsets[i]:self.offsets[i + 1]])
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self.n))]
+        if i < 0:
+            i += self.n
+        if not 0 <= i < self.n:
+            raise IndexError(i)
+        return str(self.raw(i), "utf-8")
+
+    def __iter__(self):
+        for i in range(self.n):
+            yield self[i]
+
+
+class RecordFile:
+    # Raw records appended to a side file and read back on demand; memory
+    # only holds each record's offset and length. None marks a compacted
+    # record. Without a path the file is anonymous and vanishes on close.
+    # Reads and writes go through os.pread/os.pwrite, never the file
+    # offset, which forked processes share with this one. Pickling reopens
+    # the file at its path, so an anonymous one cannot be pickled.
+
+    def __init__(self, path=None):
+        self.path = path
+        self.file = tempfile.TemporaryFile() if path is None else open(path, "w+b")
+        self.lock = threading.Lock()
+        self.starts = array("Q")
+        self.lengths = array("i")
+        self.size = 0
+
+    def __getstate__(self):
+        if self.path is None:
+            raise TypeError("cannot pickle a RecordFile without a path")
+        return {"path": self.path, "starts": self.starts, "lengths": self.lengths, "size": self.size}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.file = open(self.path, "r+b")
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.starts)
+
+    def _write(self, data):
+        start = self.size
+        view = memoryview(data)
+        while view:
+            view = view[os.pwrite(self.file.fileno(), view, self.size):]
+            self.size = start + len(data) - len(view)
+        return start
+
+    def extend(self, records):
+        data = bytearray()
+        lengths = array("i")
+        for record in records:
+            encoded = record.encode("utf-8")
+            data += encoded
+            lengths.append(len(encoded))
+        with self.lock:
+            start = self._write(data)
+            for length in lengths:
+                self.starts.append(start)
+                self.lengths.append(length)
+                start += length
+
+    def append(self, record):
+        self.extend((record,))
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        with self.lock:
+            start, length = self.starts[i], self.lengths[i]
+        if length < 0:
+            return None
+        return str(os.pread(self.file.fileno(), length, start), "utf-8")
+
+    def __setitem__(self, i, record):
+        with self.lock:
+            if record is None:
+                self.lengths[i] = -1
+                return
+            encoded = record.encode("utf-8")
+            self.starts[i] = self._write(encoded)
+            self.lengths[i] = len(encoded)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def close(self):
+        self.file.close()
+
+
+class MappedTerms(MappedStrings):
+    # Terms are sorted by their utf-8 encoding, which matches code point order.
+
+    def lower_bound(self, key):
+        lo, hi = 0, self.n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.raw(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def prefix_range(self, prefix):
+        lo = self.lower_bound(prefix)
+        hi = self.n
+        k = len(prefix)
+        start = lo
+        while start < hi:
+            mid = (start + hi) // 2
+            if self.raw(mid)[:k] == prefix:
+                start = mid + 1
+            else:
+                hi = mid
+        return lo, start
+
+    def index_of(self, term):
+        key = term.encode("utf-8")
+        i = self.lower_bound(key)
+        if i < self.n and self.raw(i) == key:
+            return i
+        return -1
+
+
+class MappedIndex:
+    __slots__ = "terms", "table", "skips", "docs", "chars", "words"
+
+    def __init__(self, terms, buf):
+        self.terms = terms
+        docs_len, positions_len, skips_len = struct.unpack_from("<QQQ", buf, 0)
+        offset = 24
+        table_len = 4 * _U64.size * (len(terms) + 1)
+        self.table = _cast_u64(buf[offset:offset + table_len])
+        offset += table_len
+        self.skips = _cast_u64(buf[offset:offset + _U64.size * skips_len])
+        offset += _U64.size * skips_len
+        self.docs = buf[offset:offset + docs_len]
+        offset += docs_len
+        self.chars = buf[offset:offset + 4 * positions_len].cast("I")
+        offset += 4 * positions_len
+        self.words = buf[offset:offset + 4 * positions_len].cast("I")
+
+    def __len__(self):
+        return len(self.terms)
+
+    def __iter__(self):
+        return iter(self.terms)
+
+    def __contains__(self, term):
+        return self.terms.index_of(term) >= 0
+
+    def _postings(self, i):
+        table = self.table
+        docs_start, positions_start, n_docs, skips_start = table[4 * i:4 * i + 4]
+        docs_end, positions_end, _, skips_end = table[4 * i + 4:4 * i + 8]
+        return PostingsList(
+            self.docs[docs_start:docs_end],
+            self.chars[positions_start:positions_end],
+            self.words[positions_start:positions_end],
+            self.skips[skips_start:skips_end],
+            n_docs,
+        )
+
+    def __getitem__(self, term):
+        i = self.terms.index_of(term)
+        if i < 0:
+            raise KeyError(term)
+        return self._postings(i)
+
+    def get(self, term, default=None):
+        i = self.terms.index_of(term)
+        if i < 0:
+            return default
+        return self._postings(i)
+
+    def items(self):
+        for i, term in enumerate(self.terms):
+            yield term, self._postings(i)
+
+
+class MappedTrie(FuzzySearchMixin):
+    # The sorted term table doubles as a flattened trie: every trie node
+    # corresponds to a contiguous range of terms sharing its path as prefix.
+    __slots__ = "terms",
+
+    def __init__(self, terms):
+        self.terms = terms
+
+    def descendants_or_self(self, prefix):
+        lo, hi = self.terms.prefix_range(prefix.encode("utf-8"))
+        return [self.terms[i] for i in range(lo, hi)]
+
+    def is_prefix(self, prefix):
+        if not prefix:
+            return False
+        lo, hi = self.terms.prefix_range(prefix.encode("utf-8"))
+        return lo < hi
+
+    def find(self, word):
+        if not word:
+            return None
+        if self.terms.index_of(word) >= 0:
+            return word
+        return None
+
+    def __contains__(self, word):
+        return self.find(word) is not None
+
+    def __len__(self):
+        return len(self.terms)
+
+    def node_count(self):
+        # nodes are ranges of the term table, none is stored
+        return 0
+
+    def _root_node(self):
+        return 0, len(self.terms), ""
+
+    def _children(self, node):
+        lo, hi, path = node
+        i = lo
+        if self._is_word(node):
+            # a word sorts before all its extensions
+            i += 1
+        k = len(path)
+        while i < hi:
+            child_path = path + self.terms[i][k]
+            _, end = self.terms.prefix_range(child_path.encode("utf-8"))
+            yield child_path[k], (i, end, child_path)
+            i = end
+
+    def _is_word(self, node):
+        lo, hi, path = node
+        return lo < hi and self.terms[lo] == path
+
+
+class MappedBKTree:
+    __slots__ = "distance_fn", "bounded", "buf", "roots", "size"
+
+    def __init__(self, buf, distance_fn, bounded=False):
+        self.distance_fn = distance_fn
+        self.bounded = bounded
+        self.buf = buf
+        header_len = struct.unpack_from("<I", buf, 0)[0]
+        header = json.loads(str(buf[4:4 + header_len], "utf-8"))
+        self.size = header["size"]
+        roots_start = 4 + header_len
+        self.roots = {
+            initial: _U64.unpack_from(buf, roots_start + _U64.size * i)[0]
+            for i, initial in enumerate(header["roots"])
+        }
+
+    def __len__(self):
+        return self.size
+
+    def find(self, word, limit, stats=None):
+        # stats as for BKTree.find
+        if not word:
+            return
+        initial = word[0]
+        if initial not in self.roots:
+            return
+
+        distance_fn = self.distance_fn
+        stack = [self.roots[initial]]
+        visited = 0
+        while stack:
+            node_word, children = self._read_node(stack.pop())
+            visited += 1
+            if self.bounded:
+                bound = limit + max(d for d, _ in children) if children else limit
+                d = distance_fn(node_word, word, bound)
+            else:
+                d = distance_fn(node_word, word)
+            if d <= limit:
+                yield d, node_word
+            for child_d, child_offset in children:
+                if d - limit <= child_d <= d + limit:
+                    stack.append(child_offset)
+        if stats is not None:
+            stats["nodes"] = stats.get("nodes", 0) + visited
+
+    def depths(self):
+        # as for BKTree.depths
+        result = collections.Counter()
+        stack = [(offset, 0) for offset in self.roots.values()]
+        while stack:
+            offset, depth = stack.pop()
+            result[depth] += 1
+            _, children = self._read_node(offset)
+            stack.extend((child_offset, depth + 1) for _, child_offset in children)
+        return result
+
+    def _read_node(self, offset):
+        word_len, n_children = _BK_NODE.unpack_from(self.buf, offset)
+        offset += _BK_NODE.size
+        word = str(self.buf[offset:offset + word_len], "utf-8")
+        offset += word_len
+        children = [
+            _BK_EDGE.unpack_from(self.buf, offset + _BK_EDGE.size * i)
+            for i in range(n_children)
+        ]
+        return word, children
+
+    def thaw(self):
+        tree = FlatBKTree(self.distance_fn, self.bounded)
+        for initial, root_offset in self.roots.items():
+            word, children = self._read_node(root_offset)
+            tree.roots[initial] = root = tree._add_node(word, 0)
+            stack = [(root, children)]
+            while stack:
+                parent, children = stack.pop()
+                for d, child_offset in children:
+                    word, grandchildren = self._read_node(child_offset)
+                    child = tree._add_node(word, d)
+                    tree.next_sibling[child] = tree.first_child[parent]
+                    tree.first_child[parent] = child
+                    tree.max_edge[parent] = max(tree.max_edge[parent], d)
+                    stack.append((child, grandchildren))
+        return tree
+
+
+def save_index(index, path):
+    terms = sorted(index.index, key=lambda t: t.encode("utf-8"))
+
+    tombstones = index._tombstones
+    postings = _encode_postings(index.index[term].without(tombstones) for term in terms)
+
+    meta = {
+        "class": type(index).__name__,
+        "n_records": len(index.records),
+        "n_terms": len(terms),
+        "deleted": sorted(index.deleted),
+        "fuzzy_engine": index.fuzzy_engine,
+    }
+    sections = [
+        (b"meta", json.dumps(meta).encode("utf-8")),
+        (b"records", _encode_strings("" if r is None else r for r in index.records)),
+        (b"doc_lengths", array("I", index.doc_lengths).tobytes()),
+        (b"terms", _encode_strings(terms)),
+        (b"postings", postings),
+    ]
+    if index.fuzzy_engine == "bktree":
+        sections.append((b"edits_lev", _encode_bktree(index.edits_lev)))
+        sections.append((b"edits_3", _encode_bktree(index.edits_3)))
+
+    # Written next to path and renamed over it: indexes loaded from path,
+    # this one included, stay mapped to the old file rather than seeing it
+    # rewritten under them.
+    tmp_path = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+    try:
+        with open(tmp_path, "xb") as f:
+            f.write(_HEADER.pack(MAGIC, VERSION, len(sections)))
+            offset = _HEADER.size + _SECTION.size * len(sections)
+            for name, data in sections:
+                # keep sections 8-byte aligned so that u64 tables can be cast in place
+                offset += -offset % 8
+                f.write(_SECTION.pack(name, offset, len(data)))
+                offset += len(data)
+            for name, data in sections:
+                f.write(b"\x00" * (-f.tell() % 8))
+                f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+def open_sections(path):
+    with open(path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    buf = memoryview(mm)
+    magic, version, n_sections = _HEADER.unpack_from(buf, 0)
+    if magic != MAGIC:
+        raise ValueError("{} is not an index file".format(path))
+    if version != VERSION:
+        raise ValueError("unsupported index file version {}".format(version))
+
+    sections = {}
+    for i in range(n_sections):
+        name, offset, length = _SECTION.unpack_from(buf, _HEADER.size + _SECTION.size * i)
+        sections[name.rstrip(b"\x00").decode("ascii")] = buf[offset:offset + length]
+    return mm, sections
+
+def load_meta(sections):
+    return json.loads(str(sections["meta"], "utf-8"))
@@ -1,5 +1,8 @@
 #!/usr/bin/python3
 
+import collections
+from array import array
+
 
 def levenshtein(x, y):
     d = [[0 for j in range(len(y) + 1)] for i in range(len(x) + 1)]
@@ -17,6 +20,88 @@ def levenshtein(x, y):
                               d[i - 1][j - 1] + 1)
     return d[len(x)][len(y)]
 
+def levenshtein_myers(x, y, limit=None):
+    # Myers/Hyyro bit-parallel algorithm with x as the pattern; python ints
+    # act as bit vectors of any width, so long words work too, just slower.
+    if not x or not y:
+        d = max(len(x), len(y))
+        return d if limit is None or d <= limit else limit + 1
+    m = len(x)
+
+    peq = {}
+    for i, c in enumerate(x):
+        peq[c] = peq.get(c, 0) | (1 << i)
+
+    mask = (1 << m) - 1
+    high = 1 << (m - 1)
+    pv = mask
+    mv = 0
+    score = m
+    remaining = len(y)
+    for c in y:
+        eq = peq.get(c, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (~(xh | pv) & mask)
+        mh = pv & xh
+        if ph & high:
+            score += 1
+        elif mh & high:
+            score -= 1
+        ph = ((ph << 1) | 1) & mask
+        mh = (mh << 1) & mask
+        pv = mh | (~(xv | ph) & mask)
+        mv = ph & xv
+
+        remaining -= 1
+        # every remaining column lowers the last row by at most one
+        if limit is not None and score - remaining > limit:
+            return limit + 1
+    return score
+
+def levenshtein_banded(x, y, limit):
+    # Ukkonen: only cells within limit of the diagonal can stay <= limit.
+    # Returns limit + 1 as soon as the distance is known to exceed limit.
+    if abs(len(x) - len(y)) > limit:
+        return limit + 1
+    if len(x) > len(y):
+        x, y = y, x
+
+    inf = limit + 1
+    n = len(y)
+    prev = [j if j <= limit else inf for j in range(n + 1)]
+    for i in range(1, len(x) + 1):
+        lo = max(1, i - limit)
+        hi = min(n, i + limit)
+        cur = [inf] * (n + 1)
+        cur[0] = i if i <= limit else inf
+        xc = x[i - 1]
+        row_min = cur[0]
+        for j in range(lo, hi + 1):
+            if xc == y[j - 1]:
+                d = prev[j - 1]
+            else:
+                d = min(prev[j - 1], prev[j], cur[j - 1]) + 1
+            if d > inf:
+                d = inf
+            cur[j] = d
+            if d < row_min:
+                row_min = d
+        if row_min > limit:
+            return inf
+        prev = cur
+    return prev[n]
+
+def levenshtein_fast(x, y, limit=None):
+    # drop-in for levenshtein; with a limit the result is min(distance, limit + 1)
+    if limit is None:
+        return levenshtein_myers(x, y)
+    if abs(len(x) - len(y)) > limit:
+        return limit + 1
+    if len(x) <= 64:
+        return levenshtein_myers(x, y, limit)
+    return levenshtein_banded(x, y, limit)
+
 def hamming(x, y):
     assert len(x) == len(y)
     d = 0
@@ -47,6 +132,17 @@ class BKNode:
             if x in self.children:
                 yield from self.children[x].find(word, distance_fn, limit)
 
+    def find_bounded(self, word, distance_fn, limit):
+        # Distances above limit + the largest child edge neither match nor
+        # reach any child, so distance_fn may give up beyond that bound.
+        bound = limit + max(self.children) if self.children else limit
+        d = distance_fn(self.word, word, bound)
+        if d <= limit:
+            yield d, self.word
+        for x in range(d - limit, d + limit + 1):
+            if x in self.children:
+                yield from self.children[x].find_bounded(word, distance_fn, limit)
+
     def print(self, indent):
         print(indent + self.word)
         for d, child in self.children.items():
@@ -55,8 +151,11 @@ class BKNode:
 
 
 class BKTree:
-    def __init__(self, distance_fn):
+    # A bounded distance_fn takes a third argument, bound, and may return
+    # any value above bound once the distance is known to exceed it.
+    def __init__(self, distance_fn, bounded=False):
         self.distance_fn = distance_fn
+        self.bounded = bounded
         self.roots = {}
         self.size = 0
 
@@ -81,12 +180,37 @@ class BKTree:
     def __len__(self):
         return self.size
 
-    def find(self, word, limit):
+    def find(self, word, limit, stats=None):
+        # stats, if given, gets the number of visited nodes added to "nodes"
+        # once the search is exhausted
         if not word:
             return
         initial = word[0]
         if initial in self.roots:
-            yield from self.roots[initial].find(word, self.distance_fn, limit)
+            distance_fn = self.distance_fn
+            if stats is not None:
+                # every visited node costs one distance_fn call
+                def distance_fn(*args, distance_fn=distance_fn):
+                    stats["nodes"] = stats.get("nodes", 0) + 1
+                    return distance_fn(*args)
+            if self.bounded:
+                yield from self.roots[initial].find_bounded(word, distance_fn, limit)
+            else:
+                yield from self.roots[initial].find(word, distance_fn, limit)
+
+    def insert_many(self, words):
+        for word in words:
+            self.insert(word)
+
+    def depths(self):
+        # {depth: number of nodes at it}, the roots at depth 0
+        result = collections.Counter()
+        stack = [(root, 0) for root in self.roots.values()]
+        while stack:
+            node, depth = stack.pop()
+            result[depth] += 1
+            stack.extend((child, depth + 1) for child in node.children.values())
+        return result
 
     def print(self):
         for initial, root in self.roots.items():
@@ -94,6 +218,125 @@ class BKTree:
             root.print("  ")
 
 
+class FlatBKTree:
+    # BKTree with the nodes kept in flat arrays instead of BKNode objects.
+    # Node i holds words[i]; its children form a linked list starting at
+    # first_child[i] and continuing through next_sibling, -1 ending it, and
+    # edge[c] is the distance between child c and its parent. max_edge[i] is
+    # the largest edge below node i, which bounds the distance worth
+    # computing there (see BKNode.find_bounded).
+    def __init__(self, distance_fn, bounded=False):
+        self.distance_fn = distance_fn
+        self.bounded = bounded
+        self.roots = {}
+        self.words = []
+        self.first_child = array("i")
+        self.next_sibling = array("i")
+        self.edge = array("H")
+        self.max_edge = array("H")
+
+    def _add_node(self, word, d):
+        self.words.append(word)
+        self.first_child.append(-1)
+        self.next_sibling.append(-1)
+        self.edge.append(d)
+        self.max_edge.append(0)
+        return len(self.words) - 1
+
+    def insert(self, word):
+        if not word:
+            return
+
+        initial = word[0]
+        cur = self.roots.get(initial)
+        if cur is None:
+            self.roots[initial] = self._add_node(word, 0)
+            return
+
+        words, first_child, next_sibling, edge = self.words, self.first_child, self.next_sibling, self.edge
+        distance_fn = self.distance_fn
+        while True:
+            d = distance_fn(words[cur], word)
+            if d == 0:
+                return
+            child = first_child[cur]
+            while child >= 0 and edge[child] != d:
+                child = next_sibling[child]
+            if child < 0:
+                break
+            cur = child
+
+        new = self._add_node(word, d)
+        next_sibling[new] = first_child[cur]
+        first_child[cur] = new
+        if d > self.max_edge[cur]:
+            self.max_edge[cur] = d
+
+    def insert_many(self, words):
+        insert = self.insert
+        for word in words:
+            insert(word)
+
+    def __len__(self):
+        return len(self.words)
+
+    def depths(self):
+        # as for BKTree.depths
+        result = collections.Counter()
+        first_child, next_sibling = self.first_child, self.next_sibling
+        stack = [(root, 0) for root in self.roots.values()]
+        while stack:
+            i, depth = stack.pop()
+            result[depth] += 1
+            child = first_child[i]
+            while child >= 0:
+                stack.append((child, depth + 1))
+                child = next_sibling[child]
+        return result
+
+    def children(self, i):
+        # (distance, child) edges of node i
+        result = []
+        child = self.first_child[i]
+        while child >= 0:
+            result.append((self.edge[child], child))
+            child = self.next_sibling[child]
+        return result
+
+    def find(self, word, limit, stats=None):
+        # stats as for BKTree.find
+        if not word:
+            return
+        root = self.roots.get(word[0])
+        if root is None:
+            return
+
+        words, first_child, next_sibling, edge, max_edge = (
+            self.words, self.first_child, self.next_sibling, self.edge, self.max_edge,
+        )
+        distance_fn = self.distance_fn
+        bounded = self.bounded
+        stack = [root]
+        visited = 0
+        while stack:
+            i = stack.pop()
+            visited += 1
+            if bounded:
+                d = distance_fn(words[i], word, limit + max_edge[i])
+            else:
+                d = distance_fn(words[i], word)
+            if d <= limit:
+                yield d, words[i]
+            lo, hi = d - limit, d + limit
+            child = first_child[i]
+            while child >= 0:
+                if lo <= edge[child] <= hi:
+                    stack.append(child)
+                child = next_sibling[child]
+        if stats is not None:
+            stats["nodes"] = stats.get("nodes", 0) + visited
+
+
 
 if __name__ == "__main__":
     t = BKTree(levenshtein)
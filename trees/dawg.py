@@ -0,0 +1,166 @@
+#!/usr/bin/python3
+
+from array import array
+from trees.trie import FuzzySearchMixin, Trie
+
+
+class DAWG(FuzzySearchMixin):
+    # Frozen, minimized form of a Trie: equal subtrees are stored once, and
+    # chains of single-child non-word states collapse into one edge with a
+    # multi-char label. Everything lives in a few flat arrays and strings:
+    # the outgoing edges of state s are edge_starts[s]:edge_starts[s + 1],
+    # edge e leads to targets[e] over labels[label_starts[e]:label_starts[e + 1]],
+    # and firsts[e] is the first char of that label. State 0 is the root.
+    #
+    # Nodes handed to FuzzySearchMixin are (state, pending) pairs, pending
+    # being the rest of an edge label still to walk before reaching state.
+    __slots__ = "edge_starts", "final", "firsts", "labels", "label_starts", "targets", "size"
+
+    def __init__(self, edge_starts, final, firsts, labels, label_starts, targets, size):
+        self.edge_starts = edge_starts
+        self.final = final
+        self.firsts = firsts
+        self.labels = labels
+        self.label_starts = label_starts
+        self.targets = targets
+        self.size = size
+
+    @classmethod
+    def from_trie(cls, trie):
+        # Minimize bottom up: a state is identified by its finality and its
+        # (char, child state) edges, so equal subtrees map to one state.
+        register = {}
+        final = []
+        edges = []
+        state_of = {}
+        stack = [(trie.root, False)]
+        while stack:
+            node, expanded = stack.pop()
+            if not expanded:
+                stack.append((node, True))
+                stack.extend((child, False) for child in node.children.values())
+                continue
+            signature = (node.is_word, tuple(sorted((c, state_of[id(child)]) for c, child in node.children.items())))
+            state = register.get(signature)
+            if state is None:
+                state = register[signature] = len(final)
+                final.append(node.is_word)
+                edges.append(signature[1])
+            state_of[id(node)] = state
+        root = state_of[id(trie.root)]
+        del register, state_of
+
+        # collapse single-child chains and renumber breadth first from the root
+        numbers = {root: 0}
+        order = [root]
+        edge_starts = array("I")
+        firsts = []
+        labels = []
+        label_starts = array("I")
+        targets = array("I")
+        n_chars = 0
+        for state in order:
+            edge_starts.append(len(targets))
+            for c, target in edges[state]:
+                label = [c]
+                while not final[target] and len(edges[target]) == 1:
+                    c, target = edges[target][0]
+                    label.append(c)
+                if target not in numbers:
+                    numbers[target] = len(order)
+                    order.append(target)
+                firsts.append(label[0])
+                labels.extend(label)
+                label_starts.append(n_chars)
+                n_chars += len(label)
+                targets.append(numbers[target])
+        edge_starts.append(len(targets))
+        label_starts.append(n_chars)
+
+        final = bytearray(final[state] for state in order)
+        return cls(edge_starts, final, "".join(firsts), "".join(labels), label_starts, targets, len(trie))
+
+    def thaw(self):
+        trie = Trie()
+        for word in self.descendants_or_self(""):
+            trie.insert(word)
+        return trie
+
+    def _edge(self, state, c):
+        # index of the edge out of state whose label starts with c, or -1
+        return self.firsts.find(c, self.edge_starts[state], self.edge_starts[state + 1])
+
+    def _label(self, edge):
+        return self.labels[self.label_starts[edge]:self.label_starts[edge + 1]]
+
+    def _walk(self, prefix):
+        # the (state, pending) node reached by prefix, None if there is none
+        state, pending = 0, ""
+        i = 0
+        while i < len(prefix):
+            if not pending:
+                edge = self._edge(state, prefix[i])
+                if edge < 0:
+                    return None
+                state, pending = self.targets[edge], self._label(edge)
+            n = min(len(pending), len(prefix) - i)
+            if prefix[i:i + n] != pending[:n]:
+                return None
+            pending = pending[n:]
+            i += n
+        return state, pending
+
+    def descendants_or_self(self, prefix):
+        node = self._walk(prefix)
+        if node is None:
+            return []
+        state, pending = node
+        words = []
+        stack = [(state, prefix + pending)]
+        while stack:
+            state, path = stack.pop()
+            if self.final[state]:
+                words.append(path)
+            # reversed, so that words come out in sorted order
+            for edge in range(self.edge_starts[state + 1] - 1, self.edge_starts[state] - 1, -1):
+                stack.append((self.targets[edge], path + self._label(edge)))
+        return words
+
+    def is_prefix(self, prefix):
+        if not prefix:
+            return False
+        return self._walk(prefix) is not None
+
+    def find(self, word):
+        if not word:
+            return None
+        node = self._walk(word)
+        if node is None or node[1] or not self.final[node[0]]:
+            return None
+        return word
+
+    def __contains__(self, word):
+        return self.find(word) is not None
+
+    def node_count(self):
+        # states, each standing for any number of equal trie subtrees
+        return len(self.final)
+
+    def __len__(self):
+        return self.size
+
+    def _root_node(self):
+        return 0, ""
+
+    def _children(self, node):
+        state, pending = node
+        if pending:
+            yield pending[0], (state, pending[1:])
+            return
+        for edge in range(self.edge_starts[state], self.edge_starts[state + 1]):
+            label = self._label(edge)
+            yield label[0], (self.targets[edge], label[1:])
+
+    def _is_word(self, node):
+        state, pending = node
+        return not pending and self.final[state]
@@ -0,0 +1,54 @@
+#!/usr/bin/python3
+
+import bisect
+from array import array
+
+SEPARATOR = "\0"
+
+
+class SuffixArray:
+    # Suffix array over a vocabulary. The terms are joined into text, each
+    # followed by SEPARATOR, which no term may contain, and suffixes holds
+    # the text offset of every suffix of every term, sorted by the suffix up
+    # to the end of its term. The suffixes starting with a query form one
+    # run of that order, found by two binary searches.
+
+    def __init__(self, terms):
+        self.terms = list(terms)
+        self.starts = array("I")
+        offset = 0
+        for term in self.terms:
+            self.starts.append(offset)
+            offset += len(term) + 1
+        self.text = text = SEPARATOR.join(self.terms) + SEPARATOR
+
+        suffixes = [
+            (text[i:start + len(term)], i)
+            for term, start in zip(self.terms, self.starts)
+            for i in range(start, start + len(term))
+        ]
+        suffixes.sort()
+        self.suffixes = array("I", (i for _, i in suffixes))
+
+    def __len__(self):
+        return len(self.terms)
+
+    def find(self, infix):
+        # {term: offset of infix in it} for the terms containing infix, the
+        # smallest offset if it occurs more than once
+        if not infix:
+            return {}
+        text, n = self.text, len(infix)
+        key = lambda i: text[i:i + n]
+        lo = bisect.bisect_left(self.suffixes, infix, key=key)
+        hi = bisect.bisect_right(self.suffixes, infix, lo, key=key)
+
+        starts, terms = self.starts, self.terms
+        found = {}
+        for i in self.suffixes[lo:hi]:
+            t = bisect.bisect_right(starts, i) - 1
+            offset = i - starts[t]
+            term = terms[t]
+            if offset < found.get(term, offset + 1):
+                found[term] = offset
+        return found
@@ -0,0 +1,101 @@
+#!/usr/bin/python3
+
+from trees.bktree import levenshtein_fast
+
+
+def deletions(word, depth):
+    # word and every distinct string left by deleting up to depth of its
+    # chars, always keeping the initial
+    variants = {word}
+    level = [word]
+    for _ in range(depth):
+        next_level = []
+        for v in level:
+            for i in range(1, len(v)):
+                d = v[:i] + v[i + 1:]
+                if d not in variants:
+                    variants.add(d)
+                    next_level.append(d)
+        level = next_level
+    return variants
+
+
+class SymSpell:
+    # Deletion-neighbourhood index. Every word is filed under its deletion
+    # variants (see deletions()), up to depths[n] deletions for a word of n
+    # chars, depths[-1] for longer ones. Two words with the same initial
+    # within Levenshtein distance k turn into the same string by deleting at
+    # most k chars after the initial from each, so find() only probes the
+    # query's variants and verifies the words filed there. That is exact as
+    # long as every word within limit of the query was stored with a depth
+    # of at least limit; memory grows with the depths, roughly
+    # len(word) ** depth variants per word.
+    #
+    # Like the BK-trees, only words sharing the query's initial are found.
+
+    def __init__(self, depths):
+        self.depths = depths
+        self.max_distance = max(depths)
+        self.words = []
+        # variant -> word id, or a list of ids once several words share it
+        self.variants = {}
+
+    def insert(self, word):
+        if not word:
+            return
+        variants = self.variants
+        entry = variants.get(word)
+        if entry is not None:
+            ids = entry if isinstance(entry, list) else (entry,)
+            if any(self.words[i] == word for i in ids):
+                return
+
+        word_id = len(self.words)
+        self.words.append(word)
+        depth = self.depths[min(len(word), len(self.depths) - 1)]
+        for v in deletions(word, depth):
+            entry = variants.get(v)
+            if entry is None:
+                variants[v] = word_id
+            elif isinstance(entry, list):
+                entry.append(word_id)
+            else:
+                variants[v] = [entry, word_id]
+
+    def insert_many(self, words):
+        insert = self.insert
+        for word in words:
+            insert(word)
+
+    def __len__(self):
+        return len(self.words)
+
+    def find(self, word, limit, stats=None):
+        # (distance, word) pairs of the stored words within limit of word;
+        # stats, if given, gets the dict probes added to "probes" and the
+        # verified words to "nodes"
+        if not word:
+            return []
+        if limit > self.max_distance:
+            raise ValueError("limit {} exceeds the stored depth {}".format(limit, self.max_distance))
+
+        variants, words = self.variants, self.words
+        seen = set()
+        result = []
+        probes = 0
+        for v in deletions(word, limit):
+            probes += 1
+            entry = variants.get(v)
+            if entry is None:
+                continue
+            for i in entry if isinstance(entry, list) else (entry,):
+                if i in seen:
+                    continue
+                seen.add(i)
+                d = levenshtein_fast(words[i], word, limit)
+                if d <= limit:
+                    result.append((d, words[i]))
+        if stats is not None:
+            stats["probes"] = stats.get("probes", 0) + probes
+            stats["nodes"] = stats.get("nodes", 0) + len(seen)
+        return result
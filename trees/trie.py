@@ -1,5 +1,57 @@
 #!/usr/bin/python3
 
+class FuzzySearchMixin:
+    # Levenshtein search by a single depth-first walk over the trie. Each node
+    # carries one row of the DP table for its path against the query, and a
+    # subtree is pruned as soon as no extension of its path can get within
+    # limit. Subclasses provide _root_node, _children and _is_word.
+    __slots__ = ()
+
+    def fuzzy_find(self, word, limit, prefix=False, exact_prefix=0, min_len=1, max_len=None):
+        # Yields (distance, word) pairs lazily. The first exact_prefix chars
+        # of word must match exactly and only paths of at least min_len chars
+        # are considered. With prefix=True a word matches with the smallest
+        # distance of any of its prefixes of min_len to max_len chars.
+        n = len(word)
+        inf = limit + 1
+        if max_len is None:
+            max_len = n + limit
+
+        stack = [(self._root_node(), "", list(range(n + 1)), inf)]
+        while stack:
+            node, path, row, best = stack.pop()
+            depth = len(path)
+
+            if row is not None and min_len <= depth <= max_len:
+                if prefix:
+                    best = min(best, row[n])
+                elif row[n] <= limit and self._is_word(node):
+                    yield row[n], path
+            if prefix and best <= limit and self._is_word(node):
+                yield best, path
+
+            if row is None or depth >= max_len or min(row) > limit:
+                if best <= limit:
+                    # every descendant matches through an already matched prefix
+                    for c, child in self._children(node):
+                        if depth < exact_prefix and c != word[depth]:
+                            continue
+                        stack.append((child, path + c, None, best))
+                continue
+
+            for c, child in self._children(node):
+                if depth < exact_prefix and c != word[depth]:
+                    continue
+                child_row = [row[0] + 1]
+                for j in range(1, n + 1):
+                    child_row.append(min(
+                        row[j] + 1,
+                        child_row[j - 1] + 1,
+                        row[j - 1] + (c != word[j - 1]),
+                    ))
+                stack.append((child, path + c, child_row, best))
+
+
 class TrieNode:
     # TODO remove self.word from node
     __slots__ = "word", "is_word", "children"
@@ -15,7 +67,7 @@ class TrieNode:
         for c, child in self.children.items():
             yield from child.descendants_or_self()
 
-class Trie:
+class Trie(FuzzySearchMixin):
 
     def __init__(self):
         self.root = TrieNode("", False)
@@ -91,6 +143,29 @@ class Trie:
     def __len__(self):
         return self.size
 
+    def node_count(self):
+        count = 0
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            count += 1
+            stack.extend(node.children.values())
+        return count
+
+    def freeze(self):
+        # a read-only copy that needs far less memory, see trees.dawg
+        from trees.dawg import DAWG
+        return DAWG.from_trie(self)
+
+    def _root_node(self):
+        return self.root
+
+    def _children(self, node):
+        return node.children.items()
+
+    def _is_word(self, node):
+        return node.is_word
+
     def __str__(self):
         s = []
         def _s(node, char, res, lvl):
@@ -120,3 +195,6 @@ if __name__ == "__main__":
     print(t)
     for x in t.descendants_or_self("ko"):
         print(x)
+
+    for x in t.fuzzy_find("kolino", 2):
+        print(x)
@@ -6,9 +6,8 @@ import sys
 
 
 class UrlIndex(index.Index):
-    def tokenize(self, record):
-        ws = [w for w in re.split("[-_/.?+&:\W]+|(\d+)", record) if w]
-        return ws
+    # split on URL punctuation, with digit runs as tokens of their own
+    token_pattern = re.compile(r"[^\W\d_]+|\d+")
 
 
 if __name__ == "__main__":
@@ -16,11 +15,7 @@ if __name__ == "__main__":
         print("wrong sys.argv. len:", len(sys.argv))
         sys.exit(1)
 
-    records = []
-    for line in sys.stdin:
-        records.append(line.strip())
-
-    index = UrlIndex(records)
+    index = UrlIndex.from_stream(line.strip() for line in sys.stdin)
     result = index.search(sys.argv[1])
-    for score, doc in result:
-        print(score, doc)
+    for d, wd, doc in result:
+        print(d, wd, doc)